@@ -1,42 +1,114 @@
+import hashlib
 import os
+from time import time
 
+import click
 from decouple import config
-from flask import Flask, redirect, render_template, url_for, session, request, jsonify, flash
+from flask import Blueprint, Flask, Markup, current_app, Response, redirect, render_template, url_for, session, request, jsonify, flash
 from flask_bcrypt import Bcrypt
+from flask.cli import with_appcontext
 from flask_cors import CORS, cross_origin
 
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:
+    sync_to_async = None
+
+from cache import TTLCache
 from forms import GetEmailForm, RegistrationForm, LoginForm, ResetPasswordForm, RouteSearchForm
-from models import OriginInfo, db, connect_db, User, Search, Station, StationDirection, RouteData
+from models import OriginInfo, db, connect_db, User, Search, SearchSession, Station, StationDirection, RouteData
 import get_routes as gr
-from sms import send
+import instrumentation
+from sms import get_worker, send
 
-app = Flask(__name__)
-CORS(app, support_credentials=True)
 
-app.config['SECRET_KEY'] = config('SECRET_KEY')
+@click.command('init-db')
+@with_appcontext
+def init_db_command():
+    """Creates the database tables that don't exist yet."""
+    db.create_all()
+    click.echo('Created the database tables.')
 
-# Heroku uses the "postgres" prefix for their database urls,
-# but this no longer works, hence the workaround below.
-try:
-    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get("DATABASE_URL").replace("://", "ql://", 1)
-except AttributeError:
-    # this is used locally and used to run tests
-    app.config['SQLALCHEMY_DATABASE_URI'] = config('DATABASE_URL')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-connect_db(app)
-db.create_all()
+@click.command('send-mail')
+@click.option('--once', is_flag=True, help='Send the mail that is due, then exit.')
+@with_appcontext
+def send_mail_command(once):
+    """
+    Runs the mail worker in the foreground. Besides new mail, it picks up
+    the emails a stopped web process left 'pending' or 'sending'.
+    """
+    worker = get_worker()
+    if once:
+        click.echo(f'Sent {worker.process_due()} emails.')
+        return
+    click.echo('Sending queued mail.')
+    worker.run()
+
+
+def create_app():
+    """
+    Creates and configures the app and registers the views on it. Nothing
+    here talks to the database or the APIs, so workers start quickly: the
+    tables are created by running 'flask init-db' once, and the API clients
+    are built on first use. The one thing loaded up front is the GTFS feed,
+    when one is configured.
+    """
+    app = Flask(__name__)
+    CORS(app, support_credentials=True)
+
+    app.config['SECRET_KEY'] = config('SECRET_KEY')
+
+    # Heroku uses the "postgres" prefix for their database urls,
+    # but this no longer works, hence the workaround below.
+    try:
+        app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get("DATABASE_URL").replace("://", "ql://", 1)
+    except AttributeError:
+        # this is used locally and used to run tests
+        app.config['SQLALCHEMY_DATABASE_URI'] = config('DATABASE_URL')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+    connect_db(app)
+    instrumentation.init_app(app)
+    app.register_blueprint(views)
+    if ASYNC_VIEWS:
+        app.view_functions['views.search_stations'] = search_stations_async
+        app.view_functions['views.show_route_results'] = show_route_results_async
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(send_mail_command)
+    # the GTFS feed, if there is one, is loaded now rather than by the first request that needs it
+    gr.get_feed()
+    return app
+
+
+# the pages and the client-side data routes, registered on the app by create_app
+views = Blueprint('views', __name__)
 
 # global variables used to send data for client-side requests
 MAP_ARRAY = ['map', 'hybrid', 'satellite', 'dark', 'light']
 
+# how long browsers may reuse the map data before revalidating it with its ETag
+API_MAX_AGE = config('API_MAX_AGE', default=300, cast=int)
+
+# rendered station cards of the results pages, keyed by (search id, station index); a search's
+# stations never change once saved, so the cards only leave the cache when they are evicted,
+# expire, or their search is replaced by a new one
+STATION_CARD_CACHE = TTLCache(maxsize=config('STATION_CARD_CACHE_SIZE', default=1024, cast=int),
+                              ttl=config('STATION_CARD_TTL', default=3600, cast=int))
+
+# serve the search and routes pages with their async variants (needs flask[async] and httpx)
+ASYNC_VIEWS = config('ASYNC_VIEWS', default=False, cast=bool)
+if ASYNC_VIEWS:
+    # only imported when used, so workers that don't need httpx don't load it
+    import async_transit as at
+
 
 """
 User registration, login, and logout methods, as well as a 404
 page and an About page.
 """
 
-@app.route('/', methods=['GET', 'POST'])
+@views.route('/', methods=['GET', 'POST'])
 def signup():
     """
     Method used to render the home / registration
@@ -53,14 +125,14 @@ def signup():
         db.session.commit()
         session['username'] = username
         flash('Your registration was successful!')
-        return redirect(url_for('search_stations'))
+        return redirect(url_for('.search_stations'))
 
     if "username" in session:
-        return redirect(url_for('search_stations'))
+        return redirect(url_for('.search_stations'))
     return render_template('register.html', form=form)
 
 
-@app.route('/login', methods=['GET', 'POST'])
+@views.route('/login', methods=['GET', 'POST'])
 def login():
     """
     Method used to render the login page and login
@@ -74,7 +146,7 @@ def login():
     if request.method == 'GET':
         if not session.get("username"):
             return render_template('login.html', form=form)
-        return redirect(url_for('search_stations'))
+        return redirect(url_for('.search_stations'))
     
     if form.validate_on_submit():
         username = form.username.data
@@ -84,25 +156,24 @@ def login():
         if user:
             session['username'] = username
             flash('Logged in successfully!')
-            return redirect(url_for('search_stations'))
+            return redirect(url_for('.search_stations'))
 
     flash('Your account was not found. Please sign up today!')
-    return redirect(url_for('signup'))
+    return redirect(url_for('.signup'))
 
 
-@app.route('/logout')
+@views.route('/logout')
 def logout():
     """Handles logging out a user."""
-    session_keys = "username num_routes num_stations email".split()
+    session_keys = "username search_id station_idx routes_version email".split()
     for key in session_keys:
-        if session.get(key):
-            session.pop(key)
+        session.pop(key, None)
 
     flash('You were successfully logged out!')
-    return redirect(url_for('login'))
+    return redirect(url_for('.login'))
 
 
-@app.route('/about')
+@views.route('/about')
 def about():
     """
     A page solely used to display the purpose
@@ -111,7 +182,7 @@ def about():
     return render_template('about.html')
 
 
-@app.route('/404')
+@views.route('/404')
 def not_found():
     """
     A page used when a user types in information
@@ -124,7 +195,7 @@ def not_found():
 Searching for transit stations, showing station results and upcoming routes.
 """
 
-@app.route('/search', methods=['GET', 'POST'])
+@views.route('/search', methods=['GET', 'POST'])
 def search_stations():
     """
     Method used to locate public transit stations within a 
@@ -132,7 +203,7 @@ def search_stations():
     """
     user = User.query.filter_by(username=session.get('username')).first()
     if not user:
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
         
     form = RouteSearchForm()
 
@@ -142,31 +213,149 @@ def search_stations():
         try:
             lat, lng = gr.get_lat_and_long(full_address)
         except TypeError:
-            return redirect(url_for('not_found'))
+            return redirect(url_for('.not_found'))
         
-        origin_info = OriginInfo(city_and_state=full_address, latitude=str(lat), longitude=str(lng), user_id=user.id)
-        db.session.add(origin_info)
-        db.session.commit()
+        search = start_search(user, full_address, lat, lng)
 
-        # gets data about stations and then packages it into an easier to read format
-        all_routes_and_stations = gr._get_routes_and_stations(lat,lng)
-        only_stations = gr.get_station_data(all_routes_and_stations)
+        # finds the stations near the address, from the stations we already know
+        # about when possible, and packages them into an easier to read format
+        only_stations, board = gr.find_stations_near(lat, lng)
         
         if only_stations:
-            Station.batch_commit(only_stations, user.id)
-            station_directions = [gr.get_directions_to_station(full_address, f'{only_stations[i][0]} {full_address}') \
-                                    for i in range(len(only_stations))]
-            StationDirection.batch_commit(station_directions, user.id)
-            return redirect(url_for('show_station_results'))
-        return redirect(url_for('not_found'))
+            station_directions = gr.get_directions_to_stations((lat, lng), only_stations)
+            search_id = finish_search(search, user, only_stations, board, station_directions)
+            return redirect(url_for('.show_station_results', search=search_id))
+        return redirect(url_for('.not_found'))
     
     # handles any GET requests based on whether the user is logged in or not
     if "username" in session:
         return render_template('search.html', form=form)
-    return redirect(url_for('login'))
+    return redirect(url_for('.login'))
+
+
+async def search_stations_async():
+    """
+    search_stations, with its geocode, departures and directions calls made on
+    the shared transit event loop. The database work runs on the request's own
+    thread.
+    """
+    user = await on_request_thread(find_user)()
+    if not user:
+        return redirect(url_for('.login'))
+
+    form = RouteSearchForm()
+
+    if form.validate_on_submit():
+        full_address = form.street_address.data
+        coords = await at.LOOP.call(at.get_lat_and_long(full_address))
+        if not coords:
+            return redirect(url_for('.not_found'))
+
+        lat, lng = coords
+        search = await on_request_thread(start_search)(user, full_address, lat, lng)
+        # HERE is only asked for the board when the stations aren't known locally
+        only_stations, board = await on_request_thread(gr.find_local_stations_near)(lat, lng), None
+        if not only_stations:
+            board = await at.LOOP.call(at.get_routes_and_stations(lat, lng))
+            only_stations = gr.stations_from_board(lat, lng, board)
+
+        if only_stations:
+            station_directions = await at.LOOP.call(at.get_directions_to_stations((lat, lng), only_stations))
+            search_id = await on_request_thread(finish_search)(search, user, only_stations, board, station_directions)
+            return redirect(url_for('.show_station_results', search=search_id))
+        return redirect(url_for('.not_found'))
+
+    return render_template('search.html', form=form)
+
+
+def on_request_thread(func):
+    """
+    Wraps a blocking function so an async view can await it. It runs on the
+    request's own thread, where the database session for the request lives.
+    """
+    return sync_to_async(func, thread_sensitive=True)
+
+
+def find_user():
+    return User.query.filter_by(username=session.get('username')).first()
+
+
+def start_search(user, full_address, lat, lng):
+    """Saves a new search and its origin, and returns the search."""
+    search = SearchSession(user_id=user.id)
+    db.session.add(search)
+    db.session.flush()
+    origin_info = OriginInfo(city_and_state=full_address, latitude=lat, longitude=lng, user_id=user.id,
+                             search_session_id=search.id)
+    db.session.add(origin_info)
+    db.session.commit()
+    return search
+
+
+def finish_search(search, user, only_stations, board, station_directions):
+    """
+    Saves the stations found by a search, with the directions to them, and
+    makes it the session's current search. Returns the search's id.
+    """
+    invalidate_station_cards(session.get("search_id"))
+    invalidate_station_cards(search.id)
+    session["search_id"] = search.id
+    # the board is kept with the search, so opening one of its stations
+    # doesn't have to ask HERE for the departures again
+    search.save_board(board)
+    Station.batch_commit(only_stations, user.id, search.id)
+    StationDirection.batch_commit(station_directions, user.id, search.id)
+    return search.id
+
+
+def invalidate_station_cards(search_id):
+    """Drops the cached station cards of a search."""
+    count = STATION_CARD_CACHE.get((search_id, 'count')) if search_id is not None else None
+    STATION_CARD_CACHE.delete((search_id, 'count'))
+    for idx in range(count or 0):
+        STATION_CARD_CACHE.delete((search_id, idx))
+
+
+def station_cards(search):
+    """
+    The rendered card of each of the search's stations, from the cache when
+    they are all there. Otherwise the stations and their directions are
+    loaded, and every card is rendered and cached again.
+    """
+    count = STATION_CARD_CACHE.get((search.id, 'count'))
+    if count:
+        cards = [STATION_CARD_CACHE.get((search.id, idx)) for idx in range(count)]
+        if None not in cards:
+            return cards
+
+    stations = [s.serialize for s in search.stations]
+    station_directions = [d.directions for d in search.directions]
+    cards = []
+    for idx, (station, directions) in enumerate(zip(stations, station_directions)):
+        card = Markup(render_template('_station_card.html', route=station, directions=directions,
+                                      map_id=MAP_ARRAY[idx] if idx < len(MAP_ARRAY) else '', idx=idx,
+                                      search_id=search.id))
+        STATION_CARD_CACHE.set((search.id, idx), card)
+        cards.append(card)
+    if cards:
+        STATION_CARD_CACHE.set((search.id, 'count'), len(cards))
+    return cards
+
+
+def get_current_search(user):
+    """
+    Finds the search a results page is about: the one named by the 'search'
+    query parameter, so that every tab keeps its own results, or else the
+    user's most recent search in this session.
+    """
+    return SearchSession.for_user(get_current_search_id(), user.id)
+
+
+def get_current_search_id():
+    return request.args.get('search', session.get('search_id'), type=int)
 
 
-@app.route('/search/results')
+@views.route('/search/results')
 def show_station_results():
     """
     Renders the page to show transit stations located near
@@ -176,19 +365,16 @@ def show_station_results():
     """
     user = User.query.filter_by(username=session.get('username')).first()
     if not user:
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
     
-    origin = user.origins[-1]
-    station_data = gr._get_routes_and_stations(float(origin.latitude),float(origin.longitude))
-    stations = gr.get_station_data(station_data)
-    session["num_stations"] = len(stations)
-    length = session["num_stations"]
-    stations = [s.serialize for s in user.stations[-length:]]
-    station_directions = [d.directions.split('+') for d in user.directions[-length:]]
-    return render_template('station_results.html', routes=stations, directions=station_directions, maps=MAP_ARRAY)
+    search = get_current_search(user)
+    cards = station_cards(search) if search else None
+    if not cards:
+        return redirect(url_for('.search_stations'))
+    return render_template('station_results.html', cards=cards)
 
 
-@app.route('/stations/<idx>/routes')
+@views.route('/stations/<idx>/routes')
 def show_route_results(idx):
     """
     Shows a list of all routes and their relevant information,
@@ -198,32 +384,117 @@ def show_route_results(idx):
     idx = int(idx)
     user = User.query.filter_by(username=session.get("username")).first()
     if not user:
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
 
-    if idx < 0 or idx > 4:
+    found = find_station(user, idx)
+    if not found:
         flash('Sorry, there are not that many available routes!')
-        return redirect(url_for('search_stations'))
+        return redirect(url_for('.search_stations'))
 
-    origin = user.origins[-1]
-    route_information = gr.get_route_data(origin.city_and_state)[idx][0]
-    session['num_routes'] = len(route_information)
-    num_routes = session["num_routes"]
+    search, station, (name, lat, lng, board), _ = found
+    route_information = gr.get_station_routes(name, lat, lng, board)
     
     # handling GET requests and edge cases.
     if not route_information:
-        return redirect(url_for('search_stations'))
-    
+        return redirect(url_for('.search_stations'))
+    return save_station_routes(user, search, station, idx, route_information)
+
+
+async def show_route_results_async(idx):
+    """
+    show_route_results, with the departures and the destination of every
+    route looked up on the shared transit event loop. The database work
+    runs on the request's own thread.
+    """
+    idx = int(idx)
+    user = await on_request_thread(find_user)()
+    if not user:
+        return redirect(url_for('.login'))
+
+    found = await on_request_thread(find_station)(user, idx)
+    if not found:
+        flash('Sorry, there are not that many available routes!')
+        return redirect(url_for('.search_stations'))
+
+    search, station, (name, lat, lng, board), (city_and_state, origin_lat_and_lng, stop_id) = found
+    route_information = await at.LOOP.call(at.get_station_routes(name, lat, lng, board))
+    if not route_information:
+        return redirect(url_for('.search_stations'))
+
+    destinations, geometries = await at.LOOP.call(at.resolve_destinations(route_information, city_and_state,
+                                                                          origin_lat_and_lng, stop_id))
+    return await on_request_thread(save_station_routes)(user, search, station, idx, route_information,
+                                                        destinations, geometries)
+
+
+def find_station(user, idx):
+    """
+    Finds the search and station a routes page is about, with what is needed
+    to look up the station's departures (its name, coordinates and the board
+    saved with the search) and their destinations (the search's origin and
+    the station's GTFS stop). Returns None if there is no such station.
+    """
+    search = get_current_search(user)
+    stations = search.stations if search else []
+    if idx < 0 or idx >= len(stations):
+        return None
+
+    origin = search.origin
+    station = stations[idx]
+    departures = (station.name, station.station_latitude, station.station_longitude,
+                  search.fresh_board(gr.SEARCH_BOARD_TTL))
+    destinations = (origin.city_and_state, {"latitude": origin.latitude, "longitude": origin.longitude},
+                    gr.station_stop_id(station))
+    return search, station, departures, destinations
+
+
+def save_station_routes(user, search, station, idx, route_information, destinations=None, geometries=None):
+    """Saves a station's routes and renders them."""
+    session["search_id"] = search.id
+    session["station_idx"] = idx
+    # the saved routes were just replaced, so the map data's ETag has to change
+    session["routes_version"] = int(time() * 1000)
+    origin = search.origin
     origin_lat_and_lng = {"latitude": origin.latitude, "longitude": origin.longitude}
-    route_names = gr.save_route_data_to_db(route_information, origin_lat_and_lng, user, origin)
-    available_routes = user.searches[-num_routes:]
-    return render_template('route_results.html',routes=available_routes, maps=MAP_ARRAY, names=route_names)
+    route_names = gr.save_route_data_to_db(route_information, origin_lat_and_lng, user, origin, station,
+                                           destinations, geometries)
+    return render_template('route_results.html', routes=station.searches, maps=MAP_ARRAY, names=route_names)
 
 
 """
 Routes called on the client side to get data from the server side.
-Used to render maps with the correct data.
+Used to render maps with the correct data. Each is also served under
+the versioned /api/v1/ prefix, and answers with a strong ETag that only
+depends on the user and the search, so that a repeat request with a
+matching If-None-Match gets a 304 without touching the database.
 """
-@app.route('/get_stations')
+
+def api_etag(*parts):
+    """A strong ETag built from the identity of the data being sent."""
+    return hashlib.sha1(':'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+def not_modified(etag):
+    """
+    Returns a 304 response if the client already has the data with this ETag.
+    Only the session cookie is read, never the database.
+    """
+    if session.get("username") and etag in request.if_none_match:
+        return cacheable(current_app.response_class(status=304), etag)
+    return None
+
+
+def cacheable(response, etag):
+    """Adds the ETag and caching headers; the data is per user, so only browsers may cache it."""
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.max_age = API_MAX_AGE
+    response.vary.add('Cookie')
+    return response
+
+
+@views.route('/get_stations')
+@views.route('/api/v1/stations')
 @cross_origin(supports_credentials=True)
 def get_stations():
     """
@@ -231,25 +502,30 @@ def get_stations():
     about the stations that will allow maps to 
     be rendered.
     """
+    etag = api_etag('stations', session.get("username"), get_current_search_id())
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
     user = User.query.filter_by(username=session.get("username")).first()
-    length = session.get("num_stations")
+    search = get_current_search(user) if user else None
 
-    if not user or not length:
+    if not search:
         return jsonify({"Error": "Could not complete request. Please log in or sign up."})
-    stations = user.stations[-length:]
     results = {}
     i = 0
-    for item in stations:
+    for item in search.stations:
         temp = []
         temp.append(item.name)
         temp.append(item.station_latitude)
         temp.append(item.station_longitude)
         results[i] = temp
         i += 1
-    return jsonify(results)
+    return cacheable(jsonify(results), etag)
 
 
-@app.route('/get_routes')
+@views.route('/get_routes')
+@views.route('/api/v1/routes')
 @cross_origin(supports_credentials=True)
 def get_routes():
     """
@@ -258,21 +534,42 @@ def get_routes():
     also gives the client-side the data that allows
     the maps to be rendered.
     """
+    idx = request.args.get('station', session.get('station_idx'), type=int)
+    etag = api_etag('routes', session.get("username"), get_current_search_id(), idx, session.get("routes_version"))
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
     user = User.query.filter_by(username=session.get("username")).first()
-    num_routes = session.get('num_routes')
-    if not user or not num_routes:
+    search = get_current_search(user) if user else None
+    if not search or idx is None or not 0 <= idx < len(search.stations):
         return jsonify({"Error": "Could not complete request. Please log in or sign up."})
-    routes = [[r.serialize for r in user.routes[-num_routes:]]]
-    route_destination_coords = [(float(r["latitude"]), float(r["longitude"])) for item in routes for r in item]
+    routes = [[r.serialize for r in search.stations[idx].routes]]
+    route_destination_coords = [(r["latitude"], r["longitude"]) for item in routes for r in item]
     
-    origin = user.origins[-1]
-    origin_lat_and_lng = {"latitude": float(origin.latitude), "longitude": float(origin.longitude)}
+    origin = search.origin
+    origin_lat_and_lng = {"latitude": origin.latitude, "longitude": origin.longitude}
 
     routes.append(origin_lat_and_lng)
     routes.append(origin.city_and_state)
     routes.append(route_destination_coords)
     
-    return jsonify(routes)
+    return cacheable(jsonify(routes), etag)
+
+
+@views.route('/metrics')
+def metrics():
+    """
+    Request, upstream API, database and template timings, and the
+    geocode cache's hits and misses, since the app started, in the
+    Prometheus text format.
+    """
+    stats = gr.geocode_cache_stats()
+    geocode = instrumentation.render_counter(
+        'ride_finder_geocode_cache_lookups_total', 'Geocode cache lookups, per cache tier and result.',
+        {(('tier', tier), ('result', result)): stats[tier][count]
+         for tier in ('memory', 'database') for result, count in (('hit', 'hits'), ('miss', 'misses'))})
+    return Response(instrumentation.render_prometheus() + geocode, mimetype='text/plain; version=0.0.4')
 
 
 """
@@ -284,7 +581,7 @@ will be hashed and stored in the database as a replacement
 for their old password.
 """
 
-@app.route('/reset/email', methods=['GET', 'POST'])
+@views.route('/reset/email', methods=['GET', 'POST'])
 def check_email():
     """
     A page used to ensure that a logged out user 
@@ -301,16 +598,17 @@ def check_email():
             msg = f"Thank you for contacting Ride Finder.\
                 Your temporary password is {dummy_pw}.\
             - The Ride Finder Team"
+            # queued for the mail worker, so the page doesn't wait on SMTP
             send(msg, user.email)
-            return redirect(url_for('reset_password', email=form.email.data))
+            return redirect(url_for('.reset_password', email=form.email.data))
 
         flash('Sorry, your email is not associated with an account!')
-        return redirect(url_for('signup'))
+        return redirect(url_for('.signup'))
 
     return render_template('reset_get_email.html', form=form)
 
 
-@app.route('/reset', methods=['GET', 'POST'])
+@views.route('/reset', methods=['GET', 'POST'])
 def reset_password():
     """
     Route that prompts the user to enter a temporary password
@@ -327,7 +625,7 @@ def reset_password():
             bcrypt = Bcrypt()
             if len(form.new_password.data) < 8:
                 flash("Your password must be eight characters long.")
-                return redirect(url_for("reset_password"))
+                return redirect(url_for(".reset_password"))
             new_hashed_pw = bcrypt.generate_password_hash(form.new_password.data).decode('utf-8')
             user = User.query.filter_by(email=session.get("email")).first()
             user.password = new_hashed_pw
@@ -337,6 +635,9 @@ def reset_password():
         else:
             flash('Sorry, the temporary password you entered was incorrect. Please request another email to reset it.')
         
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
     
-    return render_template('reset.html', form=form)
\ No newline at end of file
+    return render_template('reset.html', form=form)
+
+
+app = create_app()
@@ -0,0 +1,309 @@
+import asyncio
+import random
+import threading
+from concurrent.futures import Future
+from contextvars import Context, copy_context
+from time import perf_counter
+from typing import Any, Awaitable, Dict, List, Optional, Sequence, Tuple
+
+from decouple import config # type: ignore
+
+try:
+    import httpx # type: ignore
+except ImportError:
+    httpx = None
+
+import get_routes as gr
+from http_client import BACKOFF, CLIENT, CONNECT_TIMEOUT, MAX_RETRIES, POOL_SIZE, READ_TIMEOUT, RETRY_STATUSES
+from models import GeocodeResult
+
+GEOCODE_API_URL = 'https://maps.googleapis.com/maps/api/geocode/json'
+DIRECTIONS_API_URL = 'https://maps.googleapis.com/maps/api/directions/json'
+
+# how many upstream connections the shared event loop may have open, for all requests together
+ASYNC_MAX_CONNECTIONS = config('ASYNC_MAX_CONNECTIONS', default=100, cast=int)
+
+
+class AsyncTransitClient:
+    """
+    The asyncio counterpart of TransitClient: one httpx.AsyncClient, and so one
+    connection pool, shared by every request, with the same timeouts, retries
+    and latency histograms. It has to be used from a single event loop, the
+    shared LOOP below.
+    """
+    def __init__(self, connect_timeout: float = CONNECT_TIMEOUT, read_timeout: float = READ_TIMEOUT,
+                 max_retries: int = MAX_RETRIES, backoff: float = BACKOFF,
+                 max_connections: int = ASYNC_MAX_CONNECTIONS, transport: Any = None) -> None:
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_connections = max_connections
+        self.transport = transport
+        self._client = None
+
+
+    def _session(self) -> 'httpx.AsyncClient':
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=POOL_SIZE),
+                transport=self.transport
+            )
+        return self._client
+
+
+    async def get(self, url: str, params: Optional[Dict] = None) -> 'httpx.Response':
+        """
+        Sends a GET request, retrying 429s, 5xxs and failed connections with
+        jittered exponential backoff. Returns the last response once it
+        succeeds or the retries run out, and raises the last error if the
+        connection kept failing.
+        """
+        attempt = 0
+        while True:
+            started = perf_counter()
+            try:
+                response = await self._session().get(url, params=params)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError):
+                if attempt >= self.max_retries:
+                    raise
+            else:
+                CLIENT.record(str(response.url), perf_counter() - started)
+                if response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                    return response
+            await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+            attempt += 1
+
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+async def _in_context(context: Context, coroutine: Awaitable) -> Any:
+    # a task starts with a copy of the loop thread's context; give it the caller's
+    for var, value in context.items():
+        var.set(value)
+    return await coroutine
+
+
+class SharedLoop:
+    """
+    An event loop on a background thread that the upstream calls of every
+    request run on, so one worker process overlaps the waits of all the users
+    it is serving. Coroutines run with the context variables of the code that
+    submitted them. They must not use the database session, which belongs to
+    the request's own thread; the engine is fine.
+    """
+    def __init__(self) -> None:
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+
+
+    def _running_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='transit-loop', daemon=True).start()
+            return self._loop
+
+
+    def submit(self, coroutine: Awaitable) -> Future:
+        """Schedules the coroutine on the shared loop from any thread."""
+        return asyncio.run_coroutine_threadsafe(_in_context(copy_context(), coroutine), self._running_loop())
+
+
+    async def call(self, coroutine: Awaitable) -> Any:
+        """Runs the coroutine on the shared loop and waits for it from another event loop."""
+        return await asyncio.wrap_future(self.submit(coroutine))
+
+
+    def run(self, coroutine: Awaitable, timeout: Optional[float] = None) -> Any:
+        """Runs the coroutine on the shared loop and blocks until it is done."""
+        return self.submit(coroutine).result(timeout)
+
+
+ASYNC_CLIENT = AsyncTransitClient()
+LOOP = SharedLoop()
+
+
+"""
+The transit data layer of get_routes, as coroutines to run on the shared loop.
+They use the same caches as the blocking versions, and the same shapes of data.
+"""
+
+def google_key() -> str:
+    """The Google API key, read when it is first needed rather than when the module is imported."""
+    return config('GOOGLE_API_KEY')
+
+
+async def _geocode(search: str) -> Optional[Tuple[float, float]]:
+    search = "+".join([s.lower() for s in search.split()])
+    try:
+        response = await ASYNC_CLIENT.get(GEOCODE_API_URL, params={"address": search, "key": google_key()})
+        results = response.json()['results']
+    except (httpx.HTTPError, ValueError, KeyError):
+        return None
+    if not results:
+        return None
+    location = results[0]['geometry']['location']
+    return location['lat'], location['lng']
+
+
+async def get_lat_and_long(search: str) -> Optional[Tuple[float, float]]:
+    """gr.get_lat_and_long, with the database tier of the cache read on a worker thread."""
+    key = gr.normalize_geocode_query(search)
+    cached = gr.GEOCODE_CACHE.get(key, gr._NOT_CACHED)
+    if cached is not gr._NOT_CACHED:
+        return cached
+
+    found, coords = await asyncio.to_thread(GeocodeResult.lookup, key, gr.GEOCODE_TTL, gr.GEOCODE_MISS_TTL)
+    gr.count_geocode_lookup(found)
+    if not found:
+        coords = await _geocode(search)
+        await asyncio.to_thread(GeocodeResult.store, key, coords)
+
+    gr.GEOCODE_CACHE.set(key, coords, ttl=gr.GEOCODE_TTL if coords else gr.GEOCODE_MISS_TTL)
+    return coords
+
+
+async def _fetch_departure_board(latitude: float, longitude: float) -> Optional[List]:
+    try:
+        params = {"apikey": gr.here_key(), "in": f"{latitude},{longitude}"}
+        response = await ASYNC_CLIENT.get(gr.STATIONS_URL, params=params)
+        return response.json().get('boards')
+    except (httpx.HTTPError, ValueError):
+        return None
+
+
+async def get_routes_and_stations(latitude: float, longitude: float) -> Optional[List]:
+    """gr._get_routes_and_stations, sharing its per-cell board cache."""
+    if not latitude and not longitude:
+        return None
+    key = gr.snap_coordinates(latitude, longitude)
+    boards = gr.BOARD_CACHE.get(key)
+    if boards is None:
+        boards = await _fetch_departure_board(latitude, longitude)
+        if boards is not None:
+            gr.BOARD_CACHE.set(key, boards)
+    return boards
+
+
+async def get_directions_to_station(start: Tuple[float, float], station: Tuple[float, float]) -> List[str]:
+    params = {"origin": f"{start[0]},{start[1]}", "destination": f"{station[0]},{station[1]}", "key": google_key()}
+    response = await ASYNC_CLIENT.get(DIRECTIONS_API_URL, params=params)
+    steps = response.json()['routes'][0]['legs'][0]['steps']
+    return [gr.HTML_TAGS.sub('', step['html_instructions']) for step in steps]
+
+
+async def _gather(coroutines: Sequence[Awaitable[Any]], timeout: float, default: Any) -> List:
+    """Like gr._run_concurrently: results in order, with the default for calls that fail or time out."""
+    results = await asyncio.gather(*[asyncio.wait_for(c, timeout) for c in coroutines], return_exceptions=True)
+    return [default if isinstance(result, Exception) else result for result in results]
+
+
+async def get_directions_to_stations(origin: Tuple[float, float], stations: Dict) -> List[List[str]]:
+    """gr.get_directions_to_stations, sharing its directions cache."""
+    keys = [gr.directions_cache_key(origin, stations[i]) for i in range(len(stations))]
+    destinations = {key: (stations[i][1], stations[i][2]) for i, key in enumerate(keys)}
+    found = {key: gr.DIRECTIONS_CACHE.get(key) for key in destinations}
+
+    missing = [key for key, steps in found.items() if steps is None]
+    calls = [get_directions_to_station(origin, destinations[key]) for key in missing]
+    for key, steps in zip(missing, await _gather(calls, gr.DIRECTIONS_TIMEOUT, None)):
+        if steps is not None:
+            gr.DIRECTIONS_CACHE.set(key, steps)
+        found[key] = steps or []
+
+    return [found[key] for key in keys]
+
+
+async def get_station_routes(name: str, latitude: float, longitude: float,
+                             saved_boards: Optional[List] = None) -> Optional[List[gr.Departure]]:
+    """gr.get_station_routes: the saved board first, then HERE, then the GTFS schedule."""
+    board = None
+    if saved_boards:
+        board = gr.find_station_board(saved_boards, name, latitude, longitude, max_meters=gr.STATION_MATCH_METERS)
+
+    if board is None:
+        boards = await get_routes_and_stations(latitude, longitude)
+        if not boards:
+            return gr.get_scheduled_departures(name, latitude, longitude)
+        board = gr.find_station_board(boards, name, latitude, longitude)
+    return list(gr.iter_departures(board)) # type: ignore
+
+
+async def get_destination_coordinates(address: str, start_coords: Dict) -> Optional[Tuple[float, float]]:
+    destination = await get_lat_and_long(address)
+    if destination is None:
+        return None
+
+    params = {'apikey': gr.here_key(), 'origin': f'{start_coords["latitude"]},{start_coords["longitude"]}',
+              'destination': f'{destination[0]},{destination[1]}', 'return': 'polyline'}
+    try:
+        response = await ASYNC_CLIENT.get(gr.ROUTES_URL, params=params)
+        body = response.json()
+        location = body['routes'][0]['sections'][-1]['arrival']['place']['location']
+    except (httpx.HTTPError, ValueError, KeyError, IndexError):
+        return None
+    origin = (start_coords["latitude"], start_coords["longitude"])
+    gr.cache_route_geometry(origin, (location["lat"], location["lng"]), body)
+    return location["lat"], location["lng"]
+
+
+async def get_route_geometry(origin: Tuple[float, float], destination: Tuple[float, float]) -> Optional[str]:
+    params = {'apikey': gr.here_key(), 'origin': f'{origin[0]},{origin[1]}',
+              'destination': f'{destination[0]},{destination[1]}', 'return': 'polyline'}
+    try:
+        response = await ASYNC_CLIENT.get(gr.ROUTES_URL, params=params)
+        return gr.route_geometry(response.json())
+    except (httpx.HTTPError, ValueError):
+        return None
+
+
+async def get_route_geometries(origin: Tuple[float, float], destinations: List[Tuple[float, float]]) -> List[Optional[str]]:
+    """gr.get_route_geometries, sharing its cache of route shapes."""
+    origin = (float(origin[0]), float(origin[1]))
+    keys = [gr.route_geometry_cache_key(origin, destination) for destination in destinations]
+    targets = {key: destination for key, destination in zip(keys, destinations)
+               if key != gr.route_geometry_cache_key(origin, origin)}
+    found = {key: gr.ROUTE_GEOMETRY_CACHE.get(key) for key in targets}
+
+    missing = [key for key, geometry in found.items() if geometry is None]
+    calls = [get_route_geometry(origin, targets[key]) for key in missing]
+    for key, geometry in zip(missing, await _gather(calls, gr.DESTINATION_TIMEOUT, None)):
+        if geometry is not None:
+            gr.ROUTE_GEOMETRY_CACHE.set(key, geometry)
+        found[key] = geometry
+
+    return [found.get(key) for key in keys]
+
+
+async def resolve_destination_coordinates(route: gr.Departure, city_and_state: str, coords_dict: Dict,
+                                          stop_id: Optional[str] = None) -> Tuple[float, float]:
+    """gr.resolve_destination_coordinates: the GTFS timetable, then HERE, then the geocoding fallback."""
+    feed = gr.get_feed() if stop_id is not None else None
+    if feed is not None and stop_id is not None:
+        scheduled = gr.get_scheduled_destination(route, stop_id, feed)
+        if scheduled is not None:
+            return scheduled
+
+    coords = await get_destination_coordinates(f"{route.long_name}, {city_and_state}", coords_dict)
+    if coords is not None:
+        return coords
+    # the fallback is rare and makes blocking geocode calls, so it gets a thread
+    return await asyncio.to_thread(gr.create_destination_coordinates_fallback, route, city_and_state, coords_dict)
+
+
+async def resolve_destinations(routes: List[gr.Departure], city_and_state: str, coords_dict: Dict,
+                               stop_id: Optional[str] = None) -> Tuple[List[Tuple[float, float]], List[Optional[str]]]:
+    """
+    The destination of every route, resolved at the same time, the origin for
+    any that can't be, and then the shape of the route to each of them.
+    """
+    start_coords = (float(coords_dict['latitude']), float(coords_dict['longitude']))
+    calls = [resolve_destination_coordinates(route, city_and_state, coords_dict, stop_id) for route in routes]
+    destinations = await _gather(calls, gr.DESTINATION_TIMEOUT, start_coords)
+    return destinations, await get_route_geometries(start_coords, destinations)
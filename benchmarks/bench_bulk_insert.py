@@ -0,0 +1,91 @@
+"""
+Compares the old one-object-per-row ORM writes with models.bulk_insert for
+the rows written by a search (stations and station directions) and by a
+station's routes (searches and route data).
+
+    python benchmarks/bench_bulk_insert.py [database url] [rows per table]
+
+Uses an in-memory SQLite database by default. Point it at a scratch Postgres
+database to see the difference the round trips make; the tables are dropped
+and recreated.
+"""
+import os
+import sys
+from time import perf_counter
+
+from flask import Flask
+from sqlalchemy import event
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models import db, connect_db, bulk_insert, User, Station, StationDirection, Search, RouteData # noqa: E402
+
+
+def make_rows(model, n, user_id):
+    if model is Station:
+        return [{"name": f"Station {i}", "station_latitude": 41.8 + i / 1e4, "station_longitude": -87.6,
+                 "user_id": user_id} for i in range(n)]
+    if model is StationDirection:
+        return [{"directions": ["Head north", "Turn left"], "user_id": user_id} for i in range(n)]
+    if model is Search:
+        return [{"time": "2021-08-22 @19:52 PM", "transportation_mode": "bus", "destination": "Union Station",
+                 "website": "https://www.transitchicago.com", "user_id": user_id} for i in range(n)]
+    return [{"time": "2021-08-22 @19:52 PM", "name": "bus", "mode": "22", "headsign": "Howard",
+             "long_name": "Union Station", "website": "https://www.transitchicago.com", "latitude": 41.87,
+             "longitude": -87.64, "user_id": user_id} for i in range(n)]
+
+
+def orm_insert(model, rows):
+    for row in rows:
+        db.session.add(model(**row))
+
+
+def run(insert, model, rows, counter):
+    counter["statements"] = 0
+    start = perf_counter()
+    insert(model, rows)
+    db.session.commit()
+    elapsed = perf_counter() - start
+    model.query.delete()
+    db.session.commit()
+    return elapsed, counter["statements"]
+
+
+def main():
+    url = sys.argv[1] if len(sys.argv) > 1 else 'sqlite://'
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = url
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    connect_db(app)
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user = User(username='benchmark', password='benchmark', email='benchmark@example.com')
+        db.session.add(user)
+        db.session.commit()
+
+        counter = {"statements": 0}
+
+        @event.listens_for(db.engine, 'before_cursor_execute')
+        def count(*args):
+            counter["statements"] += 1
+
+        print(f'{n} rows per table, {url}')
+        print(f'{"table":<20}{"orm ms":>10}{"stmts":>8}{"bulk ms":>10}{"stmts":>8}')
+        for model in (Station, StationDirection, Search, RouteData):
+            rows = make_rows(model, n, user.id)
+            # warm up both paths once so the first one measured isn't penalized
+            run(orm_insert, model, rows, counter)
+            run(bulk_insert, model, rows, counter)
+            orm_time, orm_stmts = run(orm_insert, model, rows, counter)
+            bulk_time, bulk_stmts = run(bulk_insert, model, rows, counter)
+            print(f'{model.__tablename__:<20}{orm_time * 1000:>10.2f}{orm_stmts:>8}'
+                  f'{bulk_time * 1000:>10.2f}{bulk_stmts:>8}')
+
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+Drives a whole search through the Flask test client, with the Google and HERE
+APIs replayed from a cassette so that only the app's own time is measured.
+Reports p50/p95 latency, upstream API calls and database statements per
+endpoint.
+
+    python benchmarks/bench_endpoints.py [iterations] [cassette] [--warm]
+
+Uses a scratch SQLite database by default; set BENCH_DATABASE_URL to use
+another one (its tables are dropped and recreated). The geocode, board and
+directions caches are emptied before every iteration so each one does the
+full work, unless --warm is given. Needs the same environment (.env) as the
+app, since it imports it.
+"""
+import os
+import sys
+import tempfile
+from collections import defaultdict
+from math import ceil
+from time import perf_counter
+
+from sqlalchemy import event
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import app # noqa: E402
+from cassette import use_cassette # noqa: E402
+from models import db, User, GeocodeResult # noqa: E402
+import get_routes as gr # noqa: E402
+
+DEFAULT_CASSETTE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'fixtures', 'cassettes', 'chicago.json')
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    return ordered[max(0, ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def clear_caches():
+    for cache in (gr.GEOCODE_CACHE, gr.BOARD_CACHE, gr.DIRECTIONS_CACHE):
+        cache.clear()
+    GeocodeResult.query.delete()
+    db.session.commit()
+
+
+def current_search_id(client):
+    with client.session_transaction() as sesh:
+        return sesh.get("search_id")
+
+
+def one_search(client):
+    """The requests of one search, as (endpoint, method, path, data) in the order a user makes them."""
+    yield '/search', 'post', '/search', {"street_address": "Union Station, Chicago, IL"}
+    search_id = current_search_id(client)
+    yield '/search/results', 'get', f'/search/results?search={search_id}', None
+    yield '/get_stations', 'get', f'/get_stations?search={search_id}', None
+    yield '/stations/<idx>/routes', 'get', f'/stations/0/routes?search={search_id}', None
+    yield '/get_routes', 'get', f'/get_routes?search={search_id}&station=0', None
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    iterations = int(args[0]) if args else 20
+    cassette_path = args[1] if len(args) > 1 else DEFAULT_CASSETTE
+    warm = '--warm' in sys.argv
+
+    scratch = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+    url = os.environ.get('BENCH_DATABASE_URL', f'sqlite:///{scratch.name}')
+    app.config['SQLALCHEMY_DATABASE_URI'] = url
+    app.config['TESTING'] = True
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    latencies = defaultdict(list)
+    upstream = defaultdict(int)
+    statements = defaultdict(int)
+    counter = {"statements": 0}
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user = User(username='benchmark', password='benchmark', email='benchmark@example.com')
+        db.session.add(user)
+        db.session.commit()
+
+        @event.listens_for(db.engine, 'before_cursor_execute')
+        def count(*args):
+            counter["statements"] += 1
+
+        with use_cassette(cassette_path, match_endpoint=True) as cassette, app.test_client() as client:
+            with client.session_transaction() as sesh:
+                sesh["username"] = user.username
+
+            for i in range(iterations + 1):
+                if not warm:
+                    clear_caches()
+                for name, method, path, data in one_search(client):
+                    calls_before = sum(cassette.calls.values())
+                    counter["statements"] = 0
+                    start = perf_counter()
+                    resp = getattr(client, method)(path, data=data)
+                    elapsed = perf_counter() - start
+                    if resp.status_code >= 400:
+                        raise SystemExit(f'{path} returned {resp.status_code}')
+                    # the first round only warms up imports and connections
+                    if i:
+                        latencies[name].append(elapsed)
+                        upstream[name] += sum(cassette.calls.values()) - calls_before
+                        statements[name] += counter["statements"]
+
+        db.drop_all()
+    os.unlink(scratch.name)
+
+    print(f'{iterations} searches, {"warm" if warm else "cold"} caches, {url}')
+    print(f'{"endpoint":<24}{"p50 ms":>10}{"p95 ms":>10}{"upstream":>10}{"stmts":>8}')
+    for name, times in latencies.items():
+        print(f'{name:<24}{percentile(times, 50) * 1000:>10.2f}{percentile(times, 95) * 1000:>10.2f}'
+              f'{upstream[name] / iterations:>10.1f}{statements[name] / iterations:>8.1f}')
+    print('upstream calls by API:')
+    for endpoint, calls in sorted(cassette.calls.items()):
+        print(f'  {endpoint:<50}{calls:>6}')
+
+
+if __name__ == '__main__':
+    main()
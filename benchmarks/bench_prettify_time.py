@@ -0,0 +1,45 @@
+"""
+Times prettify_time over a 1,000-departure board, against the previous
+dateutil-based implementation.
+
+    python benchmarks/bench_prettify_time.py [departures]
+
+Needs the same environment (.env) as the app, since it imports get_routes.
+"""
+import os
+import sys
+from datetime import datetime, timedelta
+from timeit import repeat
+
+from dateutil.parser import parse # type: ignore
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import get_routes as gr # noqa: E402
+
+
+def dateutil_prettify_time(time: str) -> str:
+    """prettify_time as it was before the fromisoformat fast path."""
+    datetime_time = parse(time)
+    parts_of_time = [datetime_time.minute, datetime_time.hour, datetime_time.month, datetime_time.day]
+
+    for i in range(len(parts_of_time)):
+        parts_of_time[i] = parts_of_time[i] if len(str(parts_of_time[i])) == 2 else f'0{parts_of_time[i]}'
+
+    minute, hour, month, day = parts_of_time
+    pretty_time = f'{datetime_time.year}-{month}-{day} @{hour}:{minute}'
+    return f'{pretty_time} AM' if datetime_time.hour < 12 else f'{pretty_time} PM'
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    start = datetime(2021, 8, 23, 5, 35, 42)
+    board = [(start + timedelta(minutes=3 * i)).isoformat() + '-05:00' for i in range(n)]
+    assert [gr.prettify_time(t) for t in board] == [dateutil_prettify_time(t) for t in board]
+
+    for name, func in (('dateutil', dateutil_prettify_time), ('fromisoformat', gr.prettify_time)):
+        best = min(repeat(lambda: [func(t) for t in board], number=10, repeat=5)) / 10
+        print(f'{name:<14} {best * 1000:8.3f} ms per board  {best / n * 1e6:8.3f} us per departure')
+
+
+if __name__ == '__main__':
+    main()
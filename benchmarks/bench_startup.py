@@ -0,0 +1,45 @@
+"""
+Times how long a fresh worker takes to import the app and its modules, each
+in a new interpreter so nothing is cached between runs, the way a gunicorn
+worker or a test process starts.
+
+    python benchmarks/bench_startup.py [runs]
+
+Needs the same environment (.env) as the app, since it imports it. Point
+DATABASE_URL at Postgres to include any database round trips made on import.
+"""
+import os
+import subprocess
+import sys
+from statistics import median
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ('get_routes', 'sms', 'app')
+
+SNIPPET = """
+import sys
+from time import perf_counter
+start = perf_counter()
+__import__(sys.argv[1])
+print(perf_counter() - start)
+"""
+
+
+def time_import(module):
+    out = subprocess.run([sys.executable, '-c', SNIPPET, module], cwd=ROOT, check=True,
+                         capture_output=True, text=True).stdout
+    return float(out.strip().splitlines()[-1])
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    print(f'{runs} fresh interpreters per module')
+    print(f'{"module":<16}{"median ms":>12}{"min ms":>10}{"max ms":>10}')
+    for module in MODULES:
+        times = [time_import(module) for _ in range(runs)]
+        print(f'{module:<16}{median(times) * 1000:>12.1f}{min(times) * 1000:>10.1f}{max(times) * 1000:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
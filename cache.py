@@ -0,0 +1,131 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Callable, Dict, Hashable, Optional
+
+_MISSING = object()
+
+
+class _Flight:
+    """A call computing a key's value, and its result once it is done."""
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.value: Any = None
+        self.error: Optional[Exception] = None
+
+
+class TTLCache:
+    """
+    A small thread-safe, in-process cache. Entries are evicted
+    least-recently-used first once maxsize is reached, and expire
+    after ttl seconds (each entry can also be given its own ttl,
+    which is used for caching misses for a shorter time). Hits and
+    misses are counted so that the cache can be monitored.
+    get_or_set makes sure that concurrent misses for the same key
+    only compute the value once.
+    """
+    def __init__(self, maxsize: int = 1024, ttl: float = 300) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._flights: Dict[Hashable, _Flight] = {}
+
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Returns the cached value for key, or default if it is missing or expired."""
+        with self._lock:
+            value = self._lookup(key)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+
+    def get_or_set(self, key: Hashable, func: Callable[[], Any], ttl: Optional[float] = None) -> Any:
+        """
+        Returns the cached value for key, calling func to compute it on a miss.
+        Other threads that miss on the same key meanwhile wait for that call
+        and get its result, or its exception, instead of making their own. A
+        result of None is returned but not cached, so a failed upstream call
+        is retried by the next request rather than by every waiter in turn.
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        with self._lock:
+            value = self._lookup(key)
+            if value is not _MISSING:
+                return value
+            flight = self._flights.get(key)
+            leader = flight is None
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = func()
+            if flight.value is not None:
+                self.set(key, flight.value, ttl)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.value
+
+
+    def _lookup(self, key: Hashable) -> Any:
+        """Finds a live entry for key. Must be called with the lock held."""
+        entry = self._data.get(key)
+        if entry is None:
+            return _MISSING
+        if entry[1] <= monotonic():
+            del self._data[key]
+            return _MISSING
+
+        self._data.move_to_end(key)
+        return entry[0]
+
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """Stores value under key, evicting the least recently used entry if needed."""
+        expires_at = monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+
+    def clear(self) -> None:
+        """Empties the cache and resets the counters."""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._data)}
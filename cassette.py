@@ -0,0 +1,156 @@
+import json
+import os
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from decouple import config # type: ignore
+from requests import PreparedRequest, Response # type: ignore
+from requests.adapters import BaseAdapter, HTTPAdapter # type: ignore
+from requests.structures import CaseInsensitiveDict # type: ignore
+
+from http_client import CLIENT, TransitClient
+
+# HTTP_CASSETTE=fixtures/cassettes/tests.json replays the recorded API responses
+# so the tests can run offline; HTTP_CASSETTE_MODE=record records them instead.
+# HTTP_CASSETTE_MATCH_ENDPOINT lets a request that was never recorded get a
+# response recorded for another request to the same endpoint
+CASSETTE_PATH = config('HTTP_CASSETTE', default='')
+CASSETTE_MODE = config('HTTP_CASSETTE_MODE', default='replay')
+CASSETTE_MATCH_ENDPOINT = config('HTTP_CASSETTE_MATCH_ENDPOINT', default=False, cast=bool)
+
+# query parameters that hold credentials are never written to a cassette
+SECRET_PARAMS = {'apikey', 'key', 'signature', 'client'}
+
+
+class CassetteMiss(LookupError):
+    """Raised in replay mode for a request that was never recorded."""
+
+
+def endpoint(url: str) -> str:
+    parts = urlsplit(url)
+    return f'{parts.netloc}{parts.path}'
+
+
+def request_key(method: str, url: str) -> str:
+    """The method, endpoint and sorted query parameters of a request, without credentials."""
+    params = [(name, value) for name, value in parse_qsl(urlsplit(url).query, keep_blank_values=True)
+              if name.lower() not in SECRET_PARAMS]
+    return f'{method} {endpoint(url)}?{urlencode(sorted(params))}'
+
+
+class Cassette(BaseAdapter):
+    """
+    A requests transport adapter that records API traffic to a JSON file and
+    replays it. In replay mode a request gets the response recorded for the
+    same request, and any other request raises CassetteMiss. With
+    match_endpoint, it gets the response recorded for the same endpoint
+    instead, so one fixture can serve searches for different addresses.
+    Responses recorded more than once are handed out in turn. In record mode
+    requests go to the network and are kept until save() is called. Either
+    way, the calls made are counted per endpoint.
+    """
+    def __init__(self, path: str, mode: str = 'replay', transport: Optional[BaseAdapter] = None,
+                 match_endpoint: bool = False) -> None:
+        super().__init__()
+        if mode not in ('replay', 'record'):
+            raise ValueError(f'unknown cassette mode {mode!r}')
+        self.path = path
+        self.mode = mode
+        self.match_endpoint = match_endpoint
+        self.transport = transport or HTTPAdapter()
+        self.calls: Counter = Counter()
+        self.interactions: List[Dict] = []
+        self._turns: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.interactions = json.load(f)['interactions']
+
+
+    def send(self, request: PreparedRequest, **kwargs) -> Response:
+        with self._lock:
+            self.calls[endpoint(request.url)] += 1
+        if self.mode == 'record':
+            response = self.transport.send(request, **kwargs)
+            self._record(request, response)
+            return response
+        return self._build_response(request, self._find(request))
+
+
+    def _find(self, request: PreparedRequest) -> Dict:
+        key = request_key(request.method, request.url)
+        matches = [i for i in self.interactions if i['request']['key'] == key]
+        if not matches and self.match_endpoint:
+            key = f'{request.method} {endpoint(request.url)}'
+            matches = [i for i in self.interactions
+                       if i['request']['method'] == request.method and i['request']['endpoint'] == endpoint(request.url)]
+        if not matches:
+            raise CassetteMiss(f'no recorded response for {request.method} {endpoint(request.url)} in {self.path}')
+        with self._lock:
+            turn = self._turns[key]
+            self._turns[key] += 1
+        return matches[turn % len(matches)]['response']
+
+
+    def _record(self, request: PreparedRequest, response: Response) -> None:
+        with self._lock:
+            self.interactions.append({
+                "request": {"method": request.method, "endpoint": endpoint(request.url),
+                            "key": request_key(request.method, request.url)},
+                "response": {"status": response.status_code,
+                             "headers": {"Content-Type": response.headers.get('Content-Type', '')},
+                             "body": response.text}
+            })
+
+
+    def _build_response(self, request: PreparedRequest, recorded: Dict) -> Response:
+        response = Response()
+        response.status_code = recorded['status']
+        response.headers = CaseInsensitiveDict(recorded['headers'])
+        response._content = recorded['body'].encode('utf-8')
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+
+    def save(self) -> None:
+        """Writes the recorded interactions to the cassette file."""
+        with self._lock:
+            interactions = list(self.interactions)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump({"interactions": interactions}, f, indent=2)
+
+
+    def close(self) -> None:
+        self.transport.close()
+
+
+@contextmanager
+def use_cassette(path: str, mode: str = 'replay', client: TransitClient = CLIENT,
+                 match_endpoint: bool = False) -> Iterator[Cassette]:
+    """Sends the client's traffic through a cassette for the duration of the block."""
+    cassette = Cassette(path, mode, match_endpoint=match_endpoint)
+    client.mount(cassette)
+    try:
+        yield cassette
+    finally:
+        client.mount(None)
+        if mode == 'record':
+            cassette.save()
+
+
+def install(client: TransitClient = CLIENT) -> Optional[Cassette]:
+    """Mounts the cassette at HTTP_CASSETTE on the client, if one is configured."""
+    if not CASSETTE_PATH:
+        return None
+    cassette = Cassette(CASSETTE_PATH, CASSETTE_MODE, match_endpoint=CASSETTE_MATCH_ENDPOINT)
+    client.mount(cassette)
+    return cassette
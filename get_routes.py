@@ -1,19 +1,98 @@
 import re
+import threading
 from collections import defaultdict
-from typing import List, Dict, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from datetime import date, datetime, timedelta
+from math import ceil
+from time import monotonic
+from typing import Any, Callable, Iterator, List, Dict, NamedTuple, Optional, Sequence, Tuple
+from zoneinfo import ZoneInfo
 
 import requests # type: ignore
 from dateutil.parser import parse # type: ignore
 from decouple import config # type: ignore
 import googlemaps # type: ignore
 
-from models import db, Search, RouteData, OriginInfo, User
+from cache import TTLCache
+from geo import haversine_meters
+from gtfs import Feed, ScheduledDeparture, Stop
+from http_client import CLIENT, CONNECT_TIMEOUT, MAX_RETRIES, READ_TIMEOUT, RETRY_BUDGET
+from polyline import decode_flexible, encode_google, simplify
+from routing import find_terminal_stop
+from models import db, bulk_insert, Search, RouteData, OriginInfo, User, GeocodeResult, Station, SearchSession
+from spatial import STATION_INDEX, StationIndex
 
 
-KEY = config('HERE_API_KEY')
 STATIONS_URL = 'https://transit.hereapi.com/v8/departures'
 GEOCODE_URL = 'https://geocoder.ls.hereapi.com/6.2/geocode.json?apiKey={key}&searchtext={search}'
-GMAPS = googlemaps.Client(key=config('GOOGLE_API_KEY'))
+ROUTES_URL = 'https://transit.router.hereapi.com/v8/routes'
+
+# the Google Maps client is built the first time it is needed, see get_gmaps
+_GMAPS: Optional[googlemaps.Client] = None
+_GMAPS_LOCK = threading.Lock()
+
+# the thread pool upstream calls are fanned out to, shared by every request in
+# the process so the number of threads stays bounded; its threads start on first use
+MAX_WORKERS = config('MAX_WORKERS', default=8, cast=int)
+DIRECTIONS_TIMEOUT = config('DIRECTIONS_TIMEOUT', default=10.0, cast=float)
+DESTINATION_TIMEOUT = config('DESTINATION_TIMEOUT', default=15.0, cast=float)
+EXECUTOR = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='upstream')
+
+# geocoded coordinates are kept in memory, in front of the shared geocode_results table.
+# searches that Google can't find are cached too, but for a shorter time.
+GEOCODE_TTL = config('GEOCODE_TTL', default=60 * 60 * 24 * 30, cast=int)
+GEOCODE_MISS_TTL = config('GEOCODE_MISS_TTL', default=60 * 60, cast=int)
+GEOCODE_CACHE = TTLCache(maxsize=config('GEOCODE_CACHE_SIZE', default=2048, cast=int), ttl=GEOCODE_TTL)
+GEOCODE_DB_STATS = {"hits": 0, "misses": 0}
+_GEOCODE_DB_STATS_LOCK = threading.Lock()
+_NOT_CACHED = object()
+
+# departure boards are cached for a short time per grid cell (BOARD_GRID_SIZE degrees,
+# roughly 110 meters by default), so repeat views and nearby users share one HERE call.
+BOARD_GRID_SIZE = config('BOARD_GRID_SIZE', default=0.001, cast=float)
+BOARD_TTL = config('BOARD_TTL', default=60, cast=int)
+BOARD_CACHE = TTLCache(maxsize=config('BOARD_CACHE_SIZE', default=512, cast=int), ttl=BOARD_TTL)
+
+# directions to stations are cached per (origin grid cell, station); the html tags
+# Google puts in each step are stripped with a pattern compiled once
+DIRECTIONS_GRID_SIZE = config('DIRECTIONS_GRID_SIZE', default=0.0005, cast=float)
+DIRECTIONS_TTL = config('DIRECTIONS_TTL', default=60 * 60 * 24, cast=int)
+DIRECTIONS_CACHE = TTLCache(maxsize=config('DIRECTIONS_CACHE_SIZE', default=4096, cast=int), ttl=DIRECTIONS_TTL)
+HTML_TAGS = re.compile(r'(<b>)|(</b>)|(<div>)|(</div>)|(<div[\w\W]+>)|(<wbr/>)')
+
+# the shape of the route from a search's origin to each destination is drawn from a
+# simplified polyline (within ROUTE_SIMPLIFY_METERS of HERE's), cached per (origin grid
+# cell, destination) and saved with the route, so the map doesn't route anything itself
+ROUTE_SIMPLIFY_METERS = config('ROUTE_SIMPLIFY_METERS', default=15.0, cast=float)
+ROUTE_GEOMETRY_TTL = config('ROUTE_GEOMETRY_TTL', default=60 * 60 * 24, cast=int)
+ROUTE_GEOMETRY_CACHE = TTLCache(maxsize=config('ROUTE_GEOMETRY_CACHE_SIZE', default=4096, cast=int),
+                                ttl=ROUTE_GEOMETRY_TTL)
+
+# stations near a search are looked up in the local station index first, but only where
+# the index is known to be complete: within STATION_COVERAGE_METERS of the origin of an
+# earlier search whose stations HERE listed. Anywhere else HERE is asked to discover them,
+# since the index may only know the odd station another search happened to pass by.
+SEARCH_RADIUS = config('SEARCH_RADIUS', default=500, cast=int)
+MAX_STATIONS = 5
+STATION_COVERAGE_METERS = config('STATION_COVERAGE_METERS', default=100, cast=int)
+COVERAGE_INDEX = StationIndex()
+STATION_INDEX_REFRESH = config('STATION_INDEX_REFRESH', default=60, cast=int)
+
+# the board fetched during a search is saved with it and reused for its
+# station pages for SEARCH_BOARD_TTL seconds
+SEARCH_BOARD_TTL = config('SEARCH_BOARD_TTL', default=180, cast=int)
+STATION_MATCH_METERS = 50
+
+# an optional GTFS static feed (a zip file) answers station and departure lookups
+# locally, before HERE is asked. The app loads it when it starts (see create_app), so
+# no request waits for it; get_feed loads it on first use anywhere else.
+GTFS_FEED_PATH = config('GTFS_FEED_PATH', default='')
+MAX_SCHEDULED_DEPARTURES = config('MAX_SCHEDULED_DEPARTURES', default=10, cast=int)
+_FEED: Optional[Feed] = None
+_FEED_LOCK = threading.Lock()
+# a departure time as prettify_time writes it; the hour may be 24 or more for a trip past midnight
+DEPARTURE_TIME = re.compile(r'(\d{4})-(\d{2})-(\d{2}) @(\d{2,}):(\d{2})')
 
 def create_search_string_for_station_search(city: str, state: str, street_address: str = None) -> str:
     """
@@ -25,52 +104,143 @@ def create_search_string_for_station_search(city: str, state: str, street_addres
     return f'{street_address} {city} {state}'
 
 
-def get_lat_and_long(search: str) -> Optional[Tuple]:
+def normalize_geocode_query(search: str) -> str:
+    """
+    Turns a search string into the key used for the geocode cache, so that
+    'Union Station,  Chicago IL' and 'union station, chicago il' share an entry.
+    """
+    return " ".join(search.lower().split())
+
+
+def get_gmaps() -> googlemaps.Client:
+    """
+    The Google Maps client, built on first use so that importing this
+    module doesn't need the API key or set up a connection pool. Its own
+    retries get the same time budget as TransitClient's instead of the
+    library's default of a minute.
+    """
+    global _GMAPS
+    with _GMAPS_LOCK:
+        if _GMAPS is None:
+            _GMAPS = googlemaps.Client(key=config('GOOGLE_API_KEY'), connect_timeout=CONNECT_TIMEOUT,
+                                       read_timeout=READ_TIMEOUT, retry_timeout=RETRY_BUDGET,
+                                       retry_over_query_limit=MAX_RETRIES > 0,
+                                       requests_session=CLIENT.session('maps.googleapis.com'))
+    return _GMAPS
+
+
+def here_key() -> str:
+    """The HERE API key, read when it is first needed rather than when the module is imported."""
+    return config('HERE_API_KEY')
+
+
+def get_lat_and_long(search: str) -> Optional[Tuple[float, float]]:
     """
     Determines the longitude and latitude for a given address.
     Address can be as simple as a city and state, or a full
     building address, i.e. '425 W Spring St Chicago IL'.
+    Results are cached in memory and in the database, so a
+    string is only sent to Google once per GEOCODE_TTL.
     """
+    key = normalize_geocode_query(search)
+    cached = GEOCODE_CACHE.get(key, _NOT_CACHED)
+    if cached is not _NOT_CACHED:
+        return cached
+
+    found, coords = GeocodeResult.lookup(key, GEOCODE_TTL, GEOCODE_MISS_TTL)
+    count_geocode_lookup(found)
+    if not found:
+        coords = _geocode(search)
+        GeocodeResult.store(key, coords)
+
+    GEOCODE_CACHE.set(key, coords, ttl=GEOCODE_TTL if coords else GEOCODE_MISS_TTL)
+    return coords
+
+
+def _geocode(search: str) -> Optional[Tuple[float, float]]:
+    """Asks Google for the coordinates of a search string."""
     search = "+".join([s.lower() for s in search.split()])
     
     try:
-        geocoords = GMAPS.geocode(search)[0]['geometry']['location']
+        geocoords = get_gmaps().geocode(search)[0]['geometry']['location']
         return geocoords['lat'], geocoords['lng']
 
     except IndexError:
         return None
 
 
+def count_geocode_lookup(found: bool) -> None:
+    """Counts a hit or a miss in the database tier of the geocode cache; lookups run on pool threads too."""
+    with _GEOCODE_DB_STATS_LOCK:
+        GEOCODE_DB_STATS["hits" if found else "misses"] += 1
+
+
+def geocode_cache_stats() -> Dict[str, Dict[str, int]]:
+    """Hit and miss counts for both tiers of the geocode cache, shown on /metrics."""
+    with _GEOCODE_DB_STATS_LOCK:
+        database = dict(GEOCODE_DB_STATS)
+    return {"memory": GEOCODE_CACHE.stats, "database": database}
+
+
+def snap_coordinates(latitude: float, longitude: float, cell_size: float = None) -> Tuple[int, int]:
+    """
+    Snaps a pair of coordinates to the grid cell that contains them.
+    Used as the key for caches that nearby searches can share.
+    """
+    cell_size = cell_size or BOARD_GRID_SIZE
+    return round(latitude / cell_size), round(longitude / cell_size)
+
+
 def _get_routes_and_stations(latitude: float, longitude: float) -> Optional[List]:
     """
     Gets route information, including departure times
     and destinations for the given longitude and latitude
-    coordinates.
+    coordinates. Boards are cached per grid cell for BOARD_TTL
+    seconds, and only one request per cell goes to HERE at a time.
     """
     if not latitude and not longitude:
         return None
-    params = {"apikey": KEY, "in": f"{latitude},{longitude}"}
-    response = requests.get(STATIONS_URL, params=params)
-    return response.json().get('boards')
+    key = snap_coordinates(latitude, longitude)
+    return BOARD_CACHE.get_or_set(key, lambda: _fetch_departure_board(latitude, longitude))
+
+
+def _fetch_departure_board(latitude: float, longitude: float) -> Optional[List]:
+    """Asks HERE for the departures from the stations around the coordinates."""
+    params = {"apikey": here_key(), "in": f"{latitude},{longitude}"}
+    try:
+        response = CLIENT.get(STATIONS_URL, params=params)
+        return response.json().get('boards')
+    except (requests.RequestException, ValueError):
+        return None
 
 
 def prettify_time(time: str) -> str:
     """
     Takes a string timestamp and parses it into datetime.
-    Then, does some checks to add a zero if the minutes are less
-    than ten, and determines whether the time is AM or PM.
+    Then, zero-pads the minutes, hours, month and day, and
+    determines whether the time is AM or PM. The time is kept
+    in the station's own timezone, as given by its offset.
     """
-    datetime_time = parse(time)
-    parts_of_time = [datetime_time.minute, datetime_time.hour, datetime_time.month, datetime_time.day]
-    
-    for i in range(len(parts_of_time)):
-        parts_of_time[i] = parts_of_time[i] if len(str(parts_of_time[i])) == 2 else f'0{parts_of_time[i]}'
-
-    minute, hour, month, day = parts_of_time
-    pretty_time = f'{datetime_time.year}-{month}-{day} @{hour}:{minute}'
+    datetime_time = parse_departure_time(time)
+    pretty_time = (f'{datetime_time.year}-{datetime_time.month:02d}-{datetime_time.day:02d} '
+                   f'@{datetime_time.hour:02d}:{datetime_time.minute:02d}')
     return f'{pretty_time} AM' if datetime_time.hour < 12 else f'{pretty_time} PM'
 
 
+def parse_departure_time(time: str) -> datetime:
+    """
+    Parses a departure timestamp. HERE sends ISO-8601 times such as
+    '2021-08-23T05:35:42+02:00', which datetime.fromisoformat reads much
+    faster than dateutil; anything else falls back to dateutil's parser.
+    """
+    if time.endswith('Z'):
+        time = f'{time[:-1]}+00:00'
+    try:
+        return datetime.fromisoformat(time)
+    except ValueError:
+        return parse(time)
+
+
 def determine_long_form_route_name(route: Dict) -> str:
     """
     Method used to abstract some of the complexity out
@@ -89,32 +259,44 @@ def determine_long_form_route_name(route: Dict) -> str:
     return headsign if long_form_name == route['name'] else long_form_name
 
 
+class Departure(NamedTuple):
+    """One upcoming departure from a station, as shown on the route results page."""
+    time: str
+    mode: str
+    name: str
+    headsign: str
+    long_name: str
+    website: str
+
+
+def iter_departures(board: Dict) -> Iterator[Departure]:
+    """
+    Lazily turns one station's board from the HERE departures response into
+    Departures, so only the departures that are actually used get formatted.
+    """
+    for route in board['departures']:
+        transport = route['transport']
+        yield Departure(time=prettify_time(route['time']), mode=transport['mode'], name=transport['name'],
+                        headsign=transport['headsign'], long_name=determine_long_form_route_name(transport),
+                        website=route['agency'].get('website', 'None Provided'))
+
+
 def collect_route_information(data: Optional[List]) -> Optional[Dict]:
     """
     Takes in the pertinent route information such as
     departure time, destination, mode of transportation,
     and transportation website, if applicable. Returns
-    a defaultdict with a list of the information above,
-    with its key set to a number, as in 'Route #1', etc.
+    a defaultdict with a list of the Departures for every
+    station, with its key set to a number, as in 'Route #1', etc.
+    Use iter_departures when only one station is needed.
     """
     result = defaultdict(list)
-    i = 0
     if data is None:
         return None
 
     try:
-        for item in data:
-            temp = []
-            for route in item['departures']:
-                route_ = route['transport']
-                long_name = determine_long_form_route_name(route_)
-                time = prettify_time(route['time'])
-                website = route['agency'].get('website', 'None Provided')
-                route_data = [time, route_['mode'], route_['name'], 
-                                route_['headsign'], long_name, website]
-                temp.append(route_data)
-            result[i].append(temp)
-            i += 1
+        for i, item in enumerate(data):
+            result[i].append(list(iter_departures(item)))
         return result
     except TypeError:
         return None
@@ -122,7 +304,9 @@ def collect_route_information(data: Optional[List]) -> Optional[Dict]:
 
 def get_station_data(data: List) -> Dict:
     """Gets station data from available route data."""
-    stations = {}
+    stations: Dict[int, List[Any]] = {}
+    if not data:
+        return stations
     i = 0
     for item in data:
         temp = []
@@ -134,6 +318,170 @@ def get_station_data(data: List) -> Dict:
     return stations
 
 
+def refresh_station_index() -> None:
+    """
+    Adds the stations saved since the last refresh, by this worker
+    or any other, to the in-memory station index, and the origins of the
+    searches whose stations came from HERE to the coverage index.
+    """
+    rows = db.session.query(Station.id, Station.name, Station.station_latitude, Station.station_longitude) \
+                     .filter(Station.id > STATION_INDEX.last_id).order_by(Station.id).all()
+    STATION_INDEX.add_all(rows)
+
+    # a search only keeps a board when HERE was asked for its stations. An origin
+    # whose board isn't saved yet may be skipped, which only means asking HERE again.
+    origins = db.session.query(OriginInfo.id, OriginInfo.latitude, OriginInfo.longitude) \
+                        .join(SearchSession, OriginInfo.search_session_id == SearchSession.id) \
+                        .filter(SearchSession.board_fetched_at.isnot(None), OriginInfo.id > COVERAGE_INDEX.last_id) \
+                        .order_by(OriginInfo.id).all()
+    COVERAGE_INDEX.add_all((origin_id, '', latitude, longitude) for origin_id, latitude, longitude in origins)
+    STATION_INDEX.refreshed_at = monotonic()
+
+
+def find_stations_near(latitude: float, longitude: float) -> Tuple[Dict, Optional[List]]:
+    """
+    Finds the stations within SEARCH_RADIUS meters of the coordinates, in the
+    same format as get_station_data. Answered locally when possible, and from
+    the HERE departures board otherwise. Returns the stations with the board
+    they were read from, or with None when they were found locally, in which
+    case each station's board is only fetched if its routes are opened.
+    """
+    local = find_local_stations_near(latitude, longitude)
+    if local:
+        return local, None
+    boards = _get_routes_and_stations(latitude, longitude)
+    return stations_from_board(latitude, longitude, boards), boards
+
+
+def stations_from_board(latitude: float, longitude: float, boards: Optional[List]) -> Dict:
+    """
+    The stations on the departures board HERE returned for the coordinates.
+    The station index covers the area around them from then on.
+    """
+    if not boards:
+        return {}
+    COVERAGE_INDEX.add('', latitude, longitude)
+    return get_station_data(boards)
+
+
+def find_local_stations_near(latitude: float, longitude: float) -> Dict:
+    """
+    The stations near the coordinates that are known without calling HERE:
+    from the local station index when HERE has already listed the stations
+    around there, or else from the GTFS feed if one is configured. Empty if
+    neither does.
+    """
+    if monotonic() - STATION_INDEX.refreshed_at > STATION_INDEX_REFRESH:
+        refresh_station_index()
+
+    covered = COVERAGE_INDEX.nearest(latitude, longitude, 1, STATION_COVERAGE_METERS)
+    nearby = STATION_INDEX.nearest(latitude, longitude, MAX_STATIONS, SEARCH_RADIUS) if covered else []
+    if nearby:
+        return {i: [s.name, s.latitude, s.longitude] for i, s in enumerate(nearby)}
+    return find_scheduled_stops_near(latitude, longitude)
+
+
+def find_station_board(boards: List, name: str, latitude: float, longitude: float,
+                       max_meters: float = None) -> Optional[Dict]:
+    """
+    Picks the board for one station out of a departures response: the
+    board with the station's name, or else the closest one to it, as
+    long as that one is within max_meters of the station.
+    """
+    for board in boards:
+        if board['place']['name'] == name:
+            return board
+
+    def distance(board):
+        location = board['place']['location']
+        return haversine_meters(latitude, longitude, location['lat'], location['lng'])
+
+    closest = min(boards, key=distance, default=None)
+    if closest is None or (max_meters is not None and distance(closest) > max_meters):
+        return None
+    return closest
+
+
+def get_station_routes(name: str, latitude: float, longitude: float,
+                       saved_boards: Optional[List] = None) -> Optional[List[Departure]]:
+    """
+    Gets the upcoming departures from a single station. The boards saved
+    with the search are used when they include the station, so HERE is
+    only asked again when they don't. Only that station's departures
+    are parsed out of the board. If HERE has no board, the scheduled
+    departures from the GTFS feed are used, if one is configured.
+    """
+    board = None
+    if saved_boards:
+        board = find_station_board(saved_boards, name, latitude, longitude, max_meters=STATION_MATCH_METERS)
+
+    if board is None:
+        boards = _get_routes_and_stations(latitude, longitude)
+        if not boards:
+            return get_scheduled_departures(name, latitude, longitude)
+        board = find_station_board(boards, name, latitude, longitude)
+    return list(iter_departures(board)) # type: ignore
+
+
+def get_feed() -> Optional[Feed]:
+    """The GTFS feed at GTFS_FEED_PATH, or None when no feed is configured."""
+    global _FEED
+    if not GTFS_FEED_PATH:
+        return None
+    with _FEED_LOCK:
+        if _FEED is None:
+            _FEED = Feed.load(GTFS_FEED_PATH)
+    return _FEED
+
+
+def find_scheduled_stops_near(latitude: float, longitude: float, feed: Optional[Feed] = None) -> Dict:
+    """The GTFS stops within SEARCH_RADIUS meters, in the same format as get_station_data."""
+    feed = feed or get_feed()
+    if feed is None:
+        return {}
+    stops = feed.stops_near(latitude, longitude, SEARCH_RADIUS, MAX_STATIONS)
+    return {i: [stop.name, stop.latitude, stop.longitude] for i, stop in enumerate(stops)}
+
+
+def find_feed_stop(feed: Feed, name: str, latitude: float, longitude: float) -> Optional[Stop]:
+    """
+    Matches a station to the feed's stop with the same name within
+    STATION_MATCH_METERS, or else the closest stop within that distance.
+    """
+    stops = feed.stops_near(latitude, longitude, STATION_MATCH_METERS, MAX_STATIONS)
+    return next((stop for stop in stops if stop.name == name), stops[0] if stops else None)
+
+
+def departure_from_schedule(departure: ScheduledDeparture, midnight: datetime) -> Departure:
+    """Turns a departure from the GTFS feed into a Departure like the ones built from HERE."""
+    route = departure.route
+    name = route.short_name or route.long_name
+    long_name = route.long_name if route.long_name and route.long_name != name else departure.trip.headsign
+    time = prettify_time((midnight + timedelta(seconds=departure.time)).isoformat())
+    return Departure(time=time, mode=route.mode, name=name, headsign=departure.trip.headsign,
+                     long_name=long_name, website=route.url or 'None Provided')
+
+
+def get_scheduled_departures(name: str, latitude: float, longitude: float, now: Optional[datetime] = None,
+                             feed: Optional[Feed] = None) -> Optional[List[Departure]]:
+    """
+    Gets the next scheduled departures from a station out of the GTFS feed.
+    Returns None when there is no feed or no stop there.
+    """
+    feed = feed or get_feed()
+    if feed is None:
+        return None
+    stop = find_feed_stop(feed, name, latitude, longitude)
+    if stop is None:
+        return None
+
+    now = now or datetime.now(ZoneInfo(feed.timezone) if feed.timezone else None)
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    after = int((now - midnight).total_seconds())
+    return [departure_from_schedule(departure, midnight)
+            for departure in feed.next_departures(stop.stop_id, after, MAX_SCHEDULED_DEPARTURES, midnight.date())]
+
+
 def get_route_data(address: str) -> Optional[Dict]:
     """
     A wrapper to collect the data from the above functions,
@@ -148,7 +496,7 @@ def get_route_data(address: str) -> Optional[Dict]:
     return collect_route_information(route_data)
 
 
-def create_destination_coordinates_fallback(data: List, address: str, origin_coords: Dict) -> Tuple:
+def create_destination_coordinates_fallback(data: Departure, address: str, origin_coords: Dict) -> Tuple[float, float]:
     """
     A method to generate the correct coordinates (or a close estimation) for a destination
     based on factors such as transportation mode, etc. Accounts for situations in which addresses
@@ -157,8 +505,8 @@ def create_destination_coordinates_fallback(data: List, address: str, origin_coo
     """
     transit_types = ['bus', 'subway', 'ferry', 'lightRail']
     start_coords = (float(origin_coords['latitude']), float(origin_coords['longitude']))
-    transit_method = data[1]
-    destination_place_name = data[3]
+    transit_method = data.mode
+    destination_place_name = data.headsign
 
     if transit_method in transit_types:
         destination_coords = get_lat_and_long(f'{destination_place_name} {address}') or start_coords
@@ -171,14 +519,72 @@ def create_destination_coordinates_fallback(data: List, address: str, origin_coo
     return train_coords if train_coords else start_coords
 
 
-def get_directions_to_station(start_address: str, station_address: str) -> List[str]:
+def _run_concurrently(func: Callable, arguments: Sequence[Tuple], timeout: float, default: Any) -> List:
+    """
+    Calls func once for every tuple of arguments on the shared thread pool
+    and returns the results in the same order as the arguments. The batch
+    is given timeout seconds for every MAX_WORKERS calls in it; a call that
+    raises, or that hasn't finished by then, is replaced by the default, so
+    one bad upstream call does not sink the whole batch.
+    """
+    if not arguments:
+        return []
+
+    # each call runs in a copy of the caller's context, which is where Flask keeps
+    # the app context, so the calls can still reach the database
+    futures = [EXECUTOR.submit(copy_context().run, func, *args) for args in arguments]
+
+    # calls beyond the pool size have to queue, so the batch gets a timeout
+    # for each round of calls the pool needs to get through them
+    deadline = monotonic() + timeout * ceil(len(arguments) / MAX_WORKERS)
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result(timeout=max(deadline - monotonic(), 0)))
+        except Exception:
+            # a call that is still queued never starts; one that is running finishes
+            # on its worker, but the request doesn't wait for it
+            future.cancel()
+            results.append(default)
+    return results
+
+
+def get_directions_to_station(start: Any, station: Any) -> List[str]:
     """
     Method used to get directions from the address the user inputs
-    to the station found via the HERE API.
+    to the station found via the HERE API. Both ends can be given as
+    an address or as a (latitude, longitude) pair.
     """
-    directions = GMAPS.directions(start_address, station_address)[0]['legs'][0]['steps']
-    pattern = r'(<b>)|(</b>)|(<div>)|(</div>)|(<div[\w\W]+>)|(<wbr/>)'
-    return [re.sub(pattern, '', direction['html_instructions']) for direction in directions]
+    directions = get_gmaps().directions(start, station)[0]['legs'][0]['steps']
+    return [HTML_TAGS.sub('', direction['html_instructions']) for direction in directions]
+
+
+def directions_cache_key(origin: Tuple[float, float], station: List) -> Tuple:
+    """Directions are cached per origin grid cell and station."""
+    name, latitude, longitude = station
+    return snap_coordinates(*origin, DIRECTIONS_GRID_SIZE), name, round(latitude, 5), round(longitude, 5)
+
+
+def get_directions_to_stations(origin: Tuple[float, float], stations: Dict) -> List[List[str]]:
+    """
+    Gets the directions from the origin coordinates to every station, in the
+    same order as the stations. Directions from the same grid cell to the same
+    station are cached for DIRECTIONS_TTL, so nearby users share them. The rest
+    are requested at once rather than one after the other, each station only
+    once; a station whose directions could not be found gets an empty list.
+    """
+    keys = [directions_cache_key(origin, stations[i]) for i in range(len(stations))]
+    destinations = {key: (stations[i][1], stations[i][2]) for i, key in enumerate(keys)}
+    found = {key: DIRECTIONS_CACHE.get(key) for key in destinations}
+
+    missing = [key for key, steps in found.items() if steps is None]
+    arguments = [(origin, destinations[key]) for key in missing]
+    for key, steps in zip(missing, _run_concurrently(get_directions_to_station, arguments, DIRECTIONS_TIMEOUT, None)):
+        if steps is not None:
+            DIRECTIONS_CACHE.set(key, steps)
+        found[key] = steps or []
+
+    return [found[key] for key in keys]
 
 
 def get_destination_coordinates(address: str, start_coords: Dict) -> Optional[Dict]:
@@ -195,47 +601,175 @@ def get_destination_coordinates(address: str, start_coords: Dict) -> Optional[Di
         # and use the fallback method
         return None
 
-    route_url = 'https://transit.router.hereapi.com/v8/routes'
-    params = {'apikey': KEY, 'origin': f'{start_lat},{start_lng}', 
-              'destination': f'{destination_lat2},{destination_lng2}'}
+    params = {'apikey': here_key(), 'origin': f'{start_lat},{start_lng}', 
+              'destination': f'{destination_lat2},{destination_lng2}', 'return': 'polyline'}
 
-    resp = requests.get(route_url, params=params).json()
+    try:
+        resp = CLIENT.get(ROUTES_URL, params=params).json()
+    except (requests.RequestException, ValueError):
+        return None
     try:
         final_stop_coords = resp['routes'][0]['sections'][-1]['arrival']['place']['location']
     except IndexError:
         # if the above throws an error, we catch it, and move on to trying our fallback method
         return None
 
+    # this route ends at the destination, so its shape is the one the map draws
+    cache_route_geometry((start_lat, start_lng), (final_stop_coords["lat"], final_stop_coords["lng"]), resp)
     return final_stop_coords["lat"], final_stop_coords["lng"] #type: ignore
 
 
-def save_route_data_to_db(routes: List[List[str]], coords_dict: Dict, user: User, origin: OriginInfo) -> List[str]:
+def route_geometry(response: Dict) -> Optional[str]:
     """
-    As the function name says, this method collects all the data, bundles it up, 
-    and saves it all to the database. Returns a list of the route names, used in
-    the Jinja template.
+    The shape of the first route in a HERE routing response, simplified and
+    encoded as a Google polyline, or None if the response has no polylines.
     """
-    route_names = []
+    try:
+        sections = response['routes'][0]['sections']
+        points = [point for section in sections for point in decode_flexible(section['polyline'])]
+    except (KeyError, IndexError, TypeError, ValueError):
+        return None
+    return encode_google(simplify(points, ROUTE_SIMPLIFY_METERS)) if len(points) > 1 else None
 
-    for route in routes:
-        route_names.append(route[2])
-        address = f"{route[4]}, {origin.city_and_state}"
 
-        # try to get the coordinates from the HERE api, but if they aren't available,
-        # use the fallback method so that the app does not crash
-        try:
-            lat, lng = get_destination_coordinates(address, coords_dict)  # type: ignore
-        
-        except (TypeError, AttributeError):
-            lat, lng = create_destination_coordinates_fallback(route, origin.city_and_state, coords_dict)
-    
-        new_search = Search(time=route[0], transportation_mode=route[1],
-                                destination=route[4], website=route[5], user_id=user.id)
-        new_route = RouteData(time=route[0], name=route[1], mode=route[2], headsign=route[3], 
-                                long_name=route[4], website=route[5], latitude=str(lat), longitude=str(lng),
-                                user_id=user.id)
-        db.session.add(new_search)
-        db.session.add(new_route)
+def route_geometry_cache_key(origin: Tuple[float, float], destination: Tuple[float, float]) -> Tuple:
+    """Route shapes are cached per origin grid cell and destination."""
+    return snap_coordinates(*origin, DIRECTIONS_GRID_SIZE), round(destination[0], 5), round(destination[1], 5)
+
+
+def cache_route_geometry(origin: Tuple[float, float], destination: Tuple[float, float], response: Dict) -> None:
+    """Keeps the shape of a routing response that was fetched for another reason."""
+    geometry = route_geometry(response)
+    if geometry is not None:
+        ROUTE_GEOMETRY_CACHE.set(route_geometry_cache_key(origin, destination), geometry)
+
+
+def get_route_geometry(origin: Tuple[float, float], destination: Tuple[float, float]) -> Optional[str]:
+    """Asks HERE for a transit route between two points and returns its encoded, simplified shape."""
+    params = {'apikey': here_key(), 'origin': f'{origin[0]},{origin[1]}',
+              'destination': f'{destination[0]},{destination[1]}', 'return': 'polyline'}
+    try:
+        resp = CLIENT.get(ROUTES_URL, params=params).json()
+    except (requests.RequestException, ValueError):
+        return None
+    return route_geometry(resp)
+
+
+def get_route_geometries(origin: Tuple[float, float], destinations: List[Tuple[float, float]]) -> List[Optional[str]]:
+    """
+    Gets the shape of the route from the origin to every destination, in the
+    same order as the destinations. Shapes are cached for ROUTE_GEOMETRY_TTL,
+    and the missing ones are requested at once, each destination only once.
+    A destination at the origin, or one HERE can't route to, gets None, and
+    the map draws a straight line to it instead.
+    """
+    origin = (float(origin[0]), float(origin[1]))
+    keys = [route_geometry_cache_key(origin, destination) for destination in destinations]
+    targets = {key: destination for key, destination in zip(keys, destinations)
+               if key != route_geometry_cache_key(origin, origin)}
+    found = {key: ROUTE_GEOMETRY_CACHE.get(key) for key in targets}
+
+    missing = [key for key, geometry in found.items() if geometry is None]
+    arguments = [(origin, targets[key]) for key in missing]
+    for key, geometry in zip(missing, _run_concurrently(get_route_geometry, arguments, DESTINATION_TIMEOUT, None)):
+        if geometry is not None:
+            ROUTE_GEOMETRY_CACHE.set(key, geometry)
+        found[key] = geometry
+
+    return [found.get(key) for key in keys]
+
+
+def get_scheduled_destination(route: Departure, stop_id: str, feed: Feed) -> Optional[Tuple[float, float]]:
+    """
+    Gets the coordinates of the stop where a departure's trip ends from the
+    GTFS timetable, or None if no scheduled trip matches the departure.
+    """
+    match = DEPARTURE_TIME.match(route.time)
+    if not match:
+        return None
+    year, month, day, hours, minutes = (int(part) for part in match.groups())
+    try:
+        service_day = date(year, month, day)
+    except ValueError:
+        return None
+    # GTFS times of trips running past midnight go on counting from the service day, e.g. 25:10
+    departure = hours * 3600 + minutes * 60
+    terminal = find_terminal_stop(feed, stop_id, route.name, route.headsign, departure, service_day)
+    return (terminal.latitude, terminal.longitude) if terminal else None
+
+
+def resolve_destination_coordinates(route: Departure, city_and_state: str, coords_dict: Dict,
+                                    stop_id: Optional[str] = None) -> Tuple[float, float]:
+    """
+    Finds the destination coordinates for a single route. When the station
+    is a stop in the GTFS feed, the end of the route's trip is looked up in
+    the timetable. Otherwise, or if no trip matches, tries the HERE api,
+    and if the coordinates aren't available there, uses the fallback
+    method so that the app does not crash.
+    """
+    feed = get_feed() if stop_id is not None else None
+    if feed is not None and stop_id is not None:
+        scheduled = get_scheduled_destination(route, stop_id, feed)
+        if scheduled is not None:
+            return scheduled
+
+    address = f"{route.long_name}, {city_and_state}"
+    try:
+        lat, lng = get_destination_coordinates(address, coords_dict)  # type: ignore
+    except (TypeError, AttributeError, KeyError):
+        lat, lng = create_destination_coordinates_fallback(route, city_and_state, coords_dict)
+    return lat, lng
+
+
+def station_stop_id(station: Optional[Station]) -> Optional[str]:
+    """The id of the GTFS stop a saved station matches, if a feed is configured and has one."""
+    feed = get_feed() if station is not None else None
+    if feed is None or station is None:
+        return None
+    stop = find_feed_stop(feed, station.name, station.station_latitude, station.station_longitude)
+    return stop.stop_id if stop else None
+
+
+def save_route_data_to_db(routes: List[Departure], coords_dict: Dict, user: User, origin: OriginInfo,
+                          station: Station = None, destinations: Optional[List[Tuple[float, float]]] = None,
+                          geometries: Optional[List[Optional[str]]] = None) -> List[str]:
+    """
+    As the function name says, this method collects all the data, bundles it up, 
+    and saves it all to the database. Returns a list of the route names, used in
+    the Jinja template. When the routes are for a station from a search, they
+    replace the routes saved for that station before. The destination and the
+    shape of each route are found here, unless they are passed in already.
+    """
+    route_names = [route.name for route in routes]
+    start_coords = (float(coords_dict['latitude']), float(coords_dict['longitude']))
+
+    # every destination is resolved at the same time; a route that can't be
+    # resolved at all is drawn at the origin, same as the fallback method does
+    if destinations is None:
+        stop_id = station_stop_id(station)
+        arguments = [(route, origin.city_and_state, coords_dict, stop_id) for route in routes]
+        destinations = _run_concurrently(resolve_destination_coordinates, arguments,
+                                         DESTINATION_TIMEOUT, start_coords)
+    if geometries is None:
+        geometries = get_route_geometries(start_coords, destinations)
+
+    station_id = station.id if station else None
+    search_id = station.search_session_id if station else None
+    if station:
+        Search.query.filter_by(station_id=station_id).delete()
+        RouteData.query.filter_by(station_id=station_id).delete()
+
+    new_searches = []
+    new_routes = []
+    for route, (lat, lng), geometry in zip(routes, destinations, geometries):
+        new_searches.append({"time": route.time, "transportation_mode": route.mode, "destination": route.long_name,
+                             "website": route.website, "user_id": user.id, "search_session_id": search_id,
+                             "station_id": station_id})
+        new_routes.append({"time": route.time, "name": route.mode, "mode": route.name, "headsign": route.headsign,
+                           "long_name": route.long_name, "website": route.website, "latitude": lat, "longitude": lng,
+                           "polyline": geometry, "user_id": user.id, "search_session_id": search_id, "station_id": station_id})
+    bulk_insert(Search, new_searches)
+    bulk_insert(RouteData, new_routes)
     db.session.commit()
     
-    return route_names
\ No newline at end of file
+    return route_names
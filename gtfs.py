@@ -0,0 +1,251 @@
+import csv
+import io
+import zipfile
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+from spatial import StationIndex
+
+SECONDS_PER_DAY = 24 * 60 * 60
+# the weekday columns of calendar.txt, in the order of date.weekday()
+WEEKDAYS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+
+# GTFS route_type codes, named the way HERE names transport modes
+ROUTE_TYPE_MODES = {
+    0: 'lightRail', 1: 'subway', 2: 'regionalTrain', 3: 'bus', 4: 'ferry',
+    5: 'inclined', 6: 'aerial', 7: 'inclined', 11: 'bus', 12: 'monorail'
+}
+
+
+class Stop(NamedTuple):
+    stop_id: str
+    name: str
+    latitude: float
+    longitude: float
+
+
+class Route(NamedTuple):
+    route_id: str
+    short_name: str
+    long_name: str
+    mode: str
+    url: str
+
+
+class Trip(NamedTuple):
+    trip_id: str
+    route_id: str
+    headsign: str
+    service_id: str = ''
+
+
+class Service(NamedTuple):
+    """A row of calendar.txt: the weekdays a service runs on (Monday first), between two dates."""
+    weekdays: Tuple[bool, ...]
+    start: date
+    end: date
+
+
+class StopTime(NamedTuple):
+    trip_id: str
+    stop_sequence: int
+    stop_id: str
+    arrival: int
+    departure: int
+
+
+class ScheduledDeparture(NamedTuple):
+    """A departure from a stop, `time` seconds after midnight of the day asked about."""
+    time: int
+    stop_id: str
+    trip: Trip
+    route: Route
+
+
+def parse_gtfs_time(value: str) -> int:
+    """
+    Turns a GTFS 'HH:MM:SS' time into seconds after midnight of the service
+    day. Hours go past 24 for trips that run after midnight.
+    """
+    hours, minutes, seconds = value.strip().split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def parse_gtfs_date(value: str) -> date:
+    """Turns a GTFS 'YYYYMMDD' date into a date."""
+    return datetime.strptime(value.strip(), '%Y%m%d').date()
+
+
+def _read_table(archive: zipfile.ZipFile, name: str) -> Iterator[Dict[str, str]]:
+    """The rows of one of the feed's files, read as they are needed, or no rows if the feed doesn't have it."""
+    if name not in archive.namelist():
+        return
+    with archive.open(name) as raw:
+        yield from csv.DictReader(io.TextIOWrapper(raw, encoding='utf-8-sig'))
+
+
+def _read_stop_times(archive: zipfile.ZipFile) -> Iterator[StopTime]:
+    for row in _read_table(archive, 'stop_times.txt'):
+        # untimed stops in between timepoints can't be scheduled from
+        if not row.get('departure_time') and not row.get('arrival_time'):
+            continue
+        arrival = parse_gtfs_time(row.get('arrival_time') or row['departure_time'])
+        departure = parse_gtfs_time(row.get('departure_time') or row['arrival_time'])
+        yield StopTime(row['trip_id'], int(row['stop_sequence']), row['stop_id'], arrival, departure)
+
+
+def _offsets(groups: array, count: int) -> array:
+    """Where each group starts in a column sorted by group, with the end of the column last."""
+    starts = array('i', [0] * (count + 1))
+    for group in groups:
+        starts[group + 1] += 1
+    for i in range(count):
+        starts[i + 1] += starts[i]
+    return starts
+
+
+class Feed:
+    """
+    A GTFS static feed held in memory. Stops are kept in a grid index for
+    "stops near a point" lookups. stop_times, by far the biggest table, is
+    kept as columns of machine integers rather than as objects: the rows in
+    trip order, and each stop's departures sorted by time, so the next
+    departures are found with a binary search. Only the
+    trips whose service runs on the day asked about are returned, going by
+    calendar.txt and the exceptions in calendar_dates.txt; a feed with
+    neither is taken to run every trip every day.
+    """
+    def __init__(self, stops: List[Stop], routes: List[Route], trips: List[Trip],
+                 stop_times: Iterable[StopTime], timezone: Optional[str] = None,
+                 calendar: Optional[Dict[str, Service]] = None,
+                 calendar_dates: Optional[Dict[date, Dict[str, bool]]] = None) -> None:
+        self.timezone = timezone
+        self.calendar = calendar or {}
+        # service ids added (True) or removed (False) on particular dates
+        self.calendar_dates = calendar_dates or {}
+        self.stops = {stop.stop_id: stop for stop in stops}
+        self.routes = {route.route_id: route for route in routes}
+        self.trips = {trip.trip_id: trip for trip in trips}
+        self._load_stop_times(stop_times)
+
+        # the index is keyed by stop id, so stops that share a name stay apart
+        self.stop_index = StationIndex()
+        for stop in stops:
+            self.stop_index.add(stop.stop_id, stop.latitude, stop.longitude)
+
+
+    def _load_stop_times(self, stop_times: Iterable[StopTime]) -> None:
+        # trip and stop ids are numbered, and the columns hold those numbers
+        trip_numbers: Dict[str, int] = {}
+        stop_numbers: Dict[str, int] = {}
+        trip, sequence, stop, departure = array('i'), array('i'), array('i'), array('i')
+        for stop_time in stop_times:
+            trip.append(trip_numbers.setdefault(stop_time.trip_id, len(trip_numbers)))
+            sequence.append(stop_time.stop_sequence)
+            stop.append(stop_numbers.setdefault(stop_time.stop_id, len(stop_numbers)))
+            departure.append(stop_time.departure)
+        self._trip_ids = list(trip_numbers)
+        self._trip_numbers = trip_numbers
+        self._stop_ids = list(stop_numbers)
+        self._stop_numbers = stop_numbers
+
+        # sort keys are packed into one integer, which sorts much faster than tuples
+        order = sorted(range(len(trip)), key=lambda row: trip[row] << 32 | sequence[row])
+        self._trip = array('i', (trip[row] for row in order))
+        self._stop = array('i', (stop[row] for row in order))
+        self._departure = array('i', (departure[row] for row in order))
+        self._trip_start = _offsets(self._trip, len(self._trip_ids))
+
+        # nothing departs from the last stop of a trip
+        rows = [row for row in range(len(self._trip)) if row + 1 < self._trip_start[self._trip[row] + 1]]
+        rows.sort(key=lambda row: self._stop[row] << 32 | self._departure[row])
+        self._by_stop = array('i', rows)
+        self._by_stop_departure = array('i', (self._departure[row] for row in rows))
+        self._stop_start = _offsets(array('i', (self._stop[row] for row in rows)), len(self._stop_ids))
+
+
+    def trip_stop_ids(self, trip_id: str) -> List[str]:
+        """The ids of a trip's timed stops, in the order it calls at them."""
+        number = self._trip_numbers.get(trip_id)
+        if number is None:
+            return []
+        return [self._stop_ids[self._stop[row]] for row in range(self._trip_start[number], self._trip_start[number + 1])]
+
+
+    @classmethod
+    def load(cls, path) -> 'Feed':
+        """Loads a GTFS zip file, given as a path or a file object."""
+        with zipfile.ZipFile(path) as archive:
+            stops = [Stop(row['stop_id'], row.get('stop_name', ''), float(row['stop_lat']), float(row['stop_lon']))
+                     for row in _read_table(archive, 'stops.txt') if row.get('stop_lat') and row.get('stop_lon')]
+            routes = [Route(row['route_id'], row.get('route_short_name', ''), row.get('route_long_name', ''),
+                            ROUTE_TYPE_MODES.get(int(row.get('route_type') or 3), 'bus'), row.get('route_url', ''))
+                      for row in _read_table(archive, 'routes.txt')]
+            trips = [Trip(row['trip_id'], row['route_id'], row.get('trip_headsign', ''), row.get('service_id', ''))
+                     for row in _read_table(archive, 'trips.txt')]
+            calendar = {row['service_id']: Service(tuple(row.get(day) == '1' for day in WEEKDAYS),
+                                                   parse_gtfs_date(row['start_date']), parse_gtfs_date(row['end_date']))
+                        for row in _read_table(archive, 'calendar.txt')}
+            calendar_dates: Dict[date, Dict[str, bool]] = defaultdict(dict)
+            for row in _read_table(archive, 'calendar_dates.txt'):
+                # exception_type 1 adds the service on that date, 2 removes it
+                calendar_dates[parse_gtfs_date(row['date'])][row['service_id']] = row.get('exception_type') == '1'
+            agency: Dict[str, str] = next(_read_table(archive, 'agency.txt'), {})
+            # stop_times is read row by row straight into the feed's columns
+            return cls(stops, routes, trips, _read_stop_times(archive), agency.get('agency_timezone') or None,
+                       calendar, calendar_dates)
+
+
+    def services_on(self, day: date) -> Optional[Set[str]]:
+        """The ids of the services that run on a day, or None if the feed has no calendar at all."""
+        if not self.calendar and not self.calendar_dates:
+            return None
+        running = {service_id for service_id, service in self.calendar.items()
+                   if service.start <= day <= service.end and service.weekdays[day.weekday()]}
+        for service_id, added in self.calendar_dates.get(day, {}).items():
+            if added:
+                running.add(service_id)
+            else:
+                running.discard(service_id)
+        return running
+
+
+    def stops_near(self, latitude: float, longitude: float, meters: float, limit: int) -> List[Stop]:
+        """The `limit` closest stops within the given number of meters."""
+        return [self.stops[point.name] for point in self.stop_index.nearest(latitude, longitude, limit, meters)]
+
+
+    def next_departures(self, stop_id: str, after: int, limit: int,
+                        day: Optional[date] = None) -> List[ScheduledDeparture]:
+        """
+        The next `limit` departures from a stop at or after `after` seconds past
+        midnight of `day`, counting only the trips that run that day. Trips of
+        the previous service day that are still running after midnight are
+        included, with their times moved onto this day. Without a day, every
+        trip is counted.
+        """
+        number = self._stop_numbers.get(stop_id)
+        if number is None:
+            return []
+        first, end = self._stop_start[number], self._stop_start[number + 1]
+
+        found = []
+        for offset in (0, SECONDS_PER_DAY):
+            service_day = day - timedelta(days=offset // SECONDS_PER_DAY) if day else None
+            running = self.services_on(service_day) if service_day else None
+            taken = 0
+            for i in range(bisect_left(self._by_stop_departure, after + offset, first, end), end):
+                if taken == limit:
+                    break
+                row = self._by_stop[i]
+                trip = self.trips.get(self._trip_ids[self._trip[row]])
+                if trip is None or (running is not None and trip.service_id not in running):
+                    continue
+                route = self.routes.get(trip.route_id)
+                if route is not None:
+                    found.append(ScheduledDeparture(self._departure[row] - offset, stop_id, trip, route))
+                    taken += 1
+        return sorted(found, key=lambda departure: departure.time)[:limit]
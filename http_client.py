@@ -0,0 +1,159 @@
+import random
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+from urllib.parse import urlsplit
+
+import requests # type: ignore
+from requests.adapters import BaseAdapter, HTTPAdapter # type: ignore
+from decouple import config # type: ignore
+
+
+CONNECT_TIMEOUT = config('HTTP_CONNECT_TIMEOUT', default=3.05, cast=float)
+READ_TIMEOUT = config('HTTP_READ_TIMEOUT', default=10.0, cast=float)
+MAX_RETRIES = config('HTTP_MAX_RETRIES', default=2, cast=int)
+BACKOFF = config('HTTP_BACKOFF', default=0.25, cast=float)
+POOL_SIZE = config('HTTP_POOL_SIZE', default=10, cast=int)
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# the longest TransitClient keeps trying one request: every attempt timing
+# out, plus the longest backoff before each retry
+RETRY_BUDGET = (MAX_RETRIES + 1) * (CONNECT_TIMEOUT + READ_TIMEOUT) + sum(BACKOFF * 2 ** attempt for attempt in range(MAX_RETRIES))
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class LatencyHistogram:
+    """Cumulative latency histogram for one endpoint, in seconds."""
+    def __init__(self, buckets=LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self.count += 1
+            self.sum += seconds
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    self.counts[i] += 1
+
+
+    @property
+    def serialize(self) -> Dict:
+        with self._lock:
+            return {
+                "count": self.count,
+                "sum": self.sum,
+                "buckets": dict(zip(self.buckets, self.counts))
+            }
+
+
+class TransitClient:
+    """
+    The HTTP client that all HERE and Google traffic goes through. It keeps
+    one pooled, keep-alive session per host, applies connect and read timeouts
+    to every request, retries 429s, 5xxs and dropped connections with jittered
+    exponential backoff, and records a latency histogram per endpoint.
+    """
+    def __init__(self, connect_timeout: float = CONNECT_TIMEOUT, read_timeout: float = READ_TIMEOUT,
+                 max_retries: int = MAX_RETRIES, backoff: float = BACKOFF, pool_size: int = POOL_SIZE) -> None:
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.histograms: Dict[str, LatencyHistogram] = {}
+        # called with the url and latency of every response
+        self.response_hooks: List[Callable[[str, float], None]] = []
+        self._sessions: Dict[str, requests.Session] = {}
+        self._pools: Dict[str, HTTPAdapter] = {}
+        self._adapter: Optional[BaseAdapter] = None
+        self._lock = threading.Lock()
+
+
+    def session(self, host: str) -> requests.Session:
+        """Returns the shared session for a host, creating it on first use."""
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                self._pools[host] = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.hooks['response'].append(self._on_response)
+                self._sessions[host] = session
+                self._mount(host)
+            return session
+
+
+    def _mount(self, host: str) -> None:
+        adapter = self._adapter or self._pools[host]
+        self._sessions[host].mount('https://', adapter)
+        self._sessions[host].mount('http://', adapter)
+
+
+    def mount(self, adapter: Optional[BaseAdapter]) -> None:
+        """
+        Sends the requests of every session, including ones created later,
+        through the given transport adapter (a cassette, for instance)
+        instead of the connection pools. None puts the pools back.
+        """
+        with self._lock:
+            self._adapter = adapter
+            for host in self._sessions:
+                self._mount(host)
+
+
+    def get(self, url: str, params: Optional[Dict] = None) -> requests.Response:
+        """
+        Sends a GET request through the pooled session for the url's host.
+        Returns the last response once it succeeds or the retries run out,
+        and raises the last error if the connection kept failing.
+        """
+        session = self.session(urlsplit(url).netloc)
+        attempt = 0
+        while True:
+            try:
+                response = session.get(url, params=params, timeout=self.timeout)
+            except requests.ConnectionError:
+                if attempt >= self.max_retries:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                    return response
+            self._sleep_before_retry(attempt)
+            attempt += 1
+
+
+    def _sleep_before_retry(self, attempt: int) -> None:
+        """Full-jitter backoff, so that retries from many workers don't line up."""
+        time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+
+    def _on_response(self, response: requests.Response, *args, **kwargs) -> None:
+        self.record(response.url, response.elapsed.total_seconds())
+
+
+    def record(self, url: str, seconds: float) -> None:
+        """
+        Records the latency of a response from the url. Called for every
+        response this client gets, and by other clients (such as the async
+        one) so that all upstream latencies end up in the same place.
+        """
+        parts = urlsplit(url)
+        endpoint = f'{parts.netloc}{parts.path}'
+        with self._lock:
+            histogram = self.histograms.setdefault(endpoint, LatencyHistogram())
+        histogram.observe(seconds)
+        for hook in self.response_hooks:
+            hook(url, seconds)
+
+
+    def latency_stats(self) -> Dict[str, Dict]:
+        """The latency histogram of every endpoint called so far."""
+        with self._lock:
+            histograms = dict(self.histograms)
+        return {endpoint: histogram.serialize for endpoint, histogram in histograms.items()}
+
+
+CLIENT = TransitClient()
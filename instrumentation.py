@@ -0,0 +1,203 @@
+import json
+import logging
+import threading
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from decouple import config # type: ignore
+from flask import Flask, request # type: ignore
+from flask.signals import before_render_template, signals_available, template_rendered # type: ignore
+from sqlalchemy import event # type: ignore
+from sqlalchemy.engine import Engine # type: ignore
+
+from http_client import CLIENT, LatencyHistogram
+
+logger = logging.getLogger('ride_finder.requests')
+# one JSON line per request is written to stderr unless REQUEST_LOG is turned off,
+# or the app is being tested
+REQUEST_LOG = config('REQUEST_LOG', default=True, cast=bool)
+
+# the Server-Timing name of each upstream API; anything else is just "upstream"
+UPSTREAM_NAMES = {
+    'maps.googleapis.com/maps/api/geocode/json': 'geocode',
+    'maps.googleapis.com/maps/api/directions/json': 'directions',
+    'transit.hereapi.com/v8/departures': 'departures',
+    'transit.router.hereapi.com/v8/routes': 'routing',
+}
+
+
+class RequestMetrics:
+    """
+    The time spent and the number of calls made, per kind of work (each
+    upstream API, database statements, template rendering), while serving
+    one request. Calls made on worker threads add to the same metrics.
+    """
+    def __init__(self) -> None:
+        self.started = perf_counter()
+        self.timings: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+
+
+    def add(self, name: str, seconds: float) -> None:
+        with self._lock:
+            count, total = self.timings.get(name, (0, 0.0))
+            self.timings[name] = [count + 1, total + seconds]
+
+
+    def items(self) -> List[Tuple[str, int, float]]:
+        with self._lock:
+            return [(name, int(count), total) for name, (count, total) in self.timings.items()]
+
+
+_CURRENT: ContextVar[Optional[RequestMetrics]] = ContextVar('request_metrics', default=None)
+# when each template being rendered on this thread started, innermost last; templates
+# are shared between threads, so this can't be kept on the template itself
+_RENDERS_STARTED: ContextVar[Tuple[float, ...]] = ContextVar('renders_started', default=())
+
+# aggregate histograms for /metrics, keyed by (metric, label value)
+_HISTOGRAMS: Dict[Tuple[str, str], LatencyHistogram] = {}
+_HISTOGRAMS_LOCK = threading.Lock()
+
+METRICS = {
+    'request': ('ride_finder_request_duration_seconds', 'endpoint', 'Time spent serving each endpoint.'),
+    'upstream': ('ride_finder_upstream_duration_seconds', 'api', 'Time spent waiting on each upstream API.'),
+    'db': ('ride_finder_db_statement_duration_seconds', 'database', 'Time spent running database statements.'),
+    'template': ('ride_finder_template_render_duration_seconds', 'template', 'Time spent rendering templates.'),
+}
+
+
+def observe(metric: str, label: str, seconds: float) -> None:
+    """Adds a timing to the aggregate histogram for the metric and label."""
+    with _HISTOGRAMS_LOCK:
+        histogram = _HISTOGRAMS.setdefault((metric, label), LatencyHistogram())
+    histogram.observe(seconds)
+
+
+def record(name: str, seconds: float, metric: str, label: str) -> None:
+    """Attributes a timing to the current request, if there is one, and to the aggregate histograms."""
+    metrics = _CURRENT.get()
+    if metrics is not None:
+        metrics.add(name, seconds)
+    observe(metric, label, seconds)
+
+
+def _record_upstream(url: str, seconds: float) -> None:
+    parts = urlsplit(url)
+    name = UPSTREAM_NAMES.get(f'{parts.netloc}{parts.path}', 'upstream')
+    record(name, seconds, 'upstream', name)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    # the start time lives on the statement's execution context, so a statement
+    # that raises leaves nothing behind
+    if context is not None:
+        context.ride_finder_started = perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    started = getattr(context, 'ride_finder_started', None)
+    if started is not None:
+        record('db', perf_counter() - started, 'db', conn.engine.dialect.name)
+
+
+def _before_render(sender, template, context, **extra) -> None:
+    _RENDERS_STARTED.set(_RENDERS_STARTED.get() + (perf_counter(),))
+
+
+def _rendered(sender, template, context, **extra) -> None:
+    started = _RENDERS_STARTED.get()
+    if started:
+        _RENDERS_STARTED.set(started[:-1])
+        record('template', perf_counter() - started[-1], 'template', template.name or 'string')
+
+
+def server_timing(metrics: RequestMetrics, total: float) -> str:
+    """The Server-Timing header value for a request, durations in milliseconds."""
+    entries = [f'{name};dur={seconds * 1000:.1f};desc="{count} calls"' for name, count, seconds in metrics.items()]
+    entries.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(entries)
+
+
+def init_app(app: Flask) -> None:
+    """
+    Times every request to the app, with the upstream API calls, database
+    statements and template renders it makes. Each response gets a
+    Server-Timing header, and a structured log line is written for it.
+    """
+    if REQUEST_LOG and not logger.handlers:
+        logger.addHandler(logging.StreamHandler())
+        logger.setLevel(logging.INFO)
+    if _record_upstream not in CLIENT.response_hooks:
+        CLIENT.response_hooks.append(_record_upstream)
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    # template signals need blinker
+    if signals_available:
+        before_render_template.connect(_before_render, app)
+        template_rendered.connect(_rendered, app)
+
+    @app.before_request
+    def start_metrics():
+        # a render that raised never finished, so its start time is dropped here
+        _RENDERS_STARTED.set(())
+        request.environ['ride_finder.metrics_token'] = _CURRENT.set(RequestMetrics())
+
+    @app.after_request
+    def finish_metrics(response):
+        metrics = _CURRENT.get()
+        if metrics is None:
+            return response
+        total = perf_counter() - metrics.started
+        observe('request', request.url_rule.rule if request.url_rule else 'unmatched', total)
+        response.headers['Server-Timing'] = server_timing(metrics, total)
+        if not REQUEST_LOG or app.testing:
+            return response
+        logger.info(json.dumps({
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "duration_ms": round(total * 1000, 1),
+            "timings": {name: {"count": count, "ms": round(seconds * 1000, 1)}
+                        for name, count, seconds in metrics.items()}
+        }))
+        return response
+
+    @app.teardown_request
+    def clear_metrics(exc):
+        token = request.environ.pop('ride_finder.metrics_token', None)
+        if token is not None:
+            _CURRENT.reset(token)
+
+
+def render_prometheus() -> str:
+    """Every aggregate histogram, in the Prometheus text exposition format."""
+    with _HISTOGRAMS_LOCK:
+        histograms = sorted(_HISTOGRAMS.items())
+
+    lines = []
+    for metric, (name, label_name, help_text) in METRICS.items():
+        series = [(label, histogram.serialize) for (kind, label), histogram in histograms if kind == metric]
+        if not series:
+            continue
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} histogram')
+        for label, data in series:
+            label = label.replace('\\', '\\\\').replace('"', '\\"')
+            for bound, count in data['buckets'].items():
+                lines.append(f'{name}_bucket{{{label_name}="{label}",le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{{{label_name}="{label}",le="+Inf"}} {data["count"]}')
+            lines.append(f'{name}_sum{{{label_name}="{label}"}} {data["sum"]}')
+            lines.append(f'{name}_count{{{label_name}="{label}"}} {data["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+def render_counter(name: str, help_text: str, samples: Dict[Tuple[Tuple[str, str], ...], int]) -> str:
+    """A counter in the Prometheus text exposition format, one sample per set of (label, value) pairs."""
+    lines = [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+    for labels, value in samples.items():
+        label_text = ','.join(f'{label}="{label_value}"' for label, label_value in labels)
+        lines.append(f'{name}{{{label_text}}} {value}')
+    return '\n'.join(lines) + '\n'
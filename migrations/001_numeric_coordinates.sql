@@ -0,0 +1,17 @@
+-- Stores every latitude / longitude as a double instead of text.
+-- Run once against an existing Postgres database: psql $DATABASE_URL -f migrations/001_numeric_coordinates.sql
+BEGIN;
+
+ALTER TABLE origins
+    ALTER COLUMN latitude TYPE double precision USING latitude::double precision,
+    ALTER COLUMN longitude TYPE double precision USING longitude::double precision;
+
+ALTER TABLE stations
+    ALTER COLUMN station_latitude TYPE double precision USING station_latitude::double precision,
+    ALTER COLUMN station_longitude TYPE double precision USING station_longitude::double precision;
+
+ALTER TABLE route_data
+    ALTER COLUMN latitude TYPE double precision USING latitude::double precision,
+    ALTER COLUMN longitude TYPE double precision USING longitude::double precision;
+
+COMMIT;
@@ -0,0 +1,12 @@
+-- Composite (user_id, id) indexes so that "a user's latest N rows" is an
+-- index range scan (ORDER BY id DESC LIMIT n) on every history table.
+-- Run once against an existing Postgres database: psql $DATABASE_URL -f migrations/002_user_history_indexes.sql
+BEGIN;
+
+CREATE INDEX IF NOT EXISTS ix_searches_user_id_id ON searches (user_id, id);
+CREATE INDEX IF NOT EXISTS ix_origins_user_id_id ON origins (user_id, id);
+CREATE INDEX IF NOT EXISTS ix_stations_user_id_id ON stations (user_id, id);
+CREATE INDEX IF NOT EXISTS ix_station_directions_user_id_id ON station_directions (user_id, id);
+CREATE INDEX IF NOT EXISTS ix_route_data_user_id_id ON route_data (user_id, id);
+
+COMMIT;
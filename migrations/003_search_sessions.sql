@@ -0,0 +1,30 @@
+-- Groups the rows of each search under a search_sessions row, so results
+-- pages load one search by id instead of "the user's last N rows".
+-- Rows saved before this migration keep a NULL search_session_id.
+-- Run once against an existing Postgres database: psql $DATABASE_URL -f migrations/003_search_sessions.sql
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS search_sessions (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    created_at TIMESTAMP NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS ix_search_sessions_user_id_id ON search_sessions (user_id, id);
+
+ALTER TABLE origins ADD COLUMN IF NOT EXISTS search_session_id INTEGER REFERENCES search_sessions (id) ON DELETE CASCADE;
+ALTER TABLE stations ADD COLUMN IF NOT EXISTS search_session_id INTEGER REFERENCES search_sessions (id) ON DELETE CASCADE;
+ALTER TABLE station_directions ADD COLUMN IF NOT EXISTS search_session_id INTEGER REFERENCES search_sessions (id) ON DELETE CASCADE;
+ALTER TABLE searches ADD COLUMN IF NOT EXISTS search_session_id INTEGER REFERENCES search_sessions (id) ON DELETE CASCADE;
+ALTER TABLE searches ADD COLUMN IF NOT EXISTS station_id INTEGER REFERENCES stations (id) ON DELETE CASCADE;
+ALTER TABLE route_data ADD COLUMN IF NOT EXISTS search_session_id INTEGER REFERENCES search_sessions (id) ON DELETE CASCADE;
+ALTER TABLE route_data ADD COLUMN IF NOT EXISTS station_id INTEGER REFERENCES stations (id) ON DELETE CASCADE;
+
+CREATE INDEX IF NOT EXISTS ix_origins_search_session_id ON origins (search_session_id);
+CREATE INDEX IF NOT EXISTS ix_stations_search_session_id ON stations (search_session_id);
+CREATE INDEX IF NOT EXISTS ix_station_directions_search_session_id ON station_directions (search_session_id);
+CREATE INDEX IF NOT EXISTS ix_searches_search_session_id ON searches (search_session_id);
+CREATE INDEX IF NOT EXISTS ix_searches_station_id ON searches (station_id);
+CREATE INDEX IF NOT EXISTS ix_route_data_search_session_id ON route_data (search_session_id);
+CREATE INDEX IF NOT EXISTS ix_route_data_station_id ON route_data (station_id);
+
+COMMIT;
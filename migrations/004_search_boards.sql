@@ -0,0 +1,9 @@
+-- Keeps the HERE departures board fetched during a search with the search,
+-- so its station pages can reuse it while it is fresh.
+-- Run once against an existing Postgres database: psql $DATABASE_URL -f migrations/004_search_boards.sql
+BEGIN;
+
+ALTER TABLE search_sessions ADD COLUMN IF NOT EXISTS board JSON;
+ALTER TABLE search_sessions ADD COLUMN IF NOT EXISTS board_fetched_at TIMESTAMP;
+
+COMMIT;
@@ -0,0 +1,12 @@
+-- Stores the directions to a station as a JSON array of steps instead of one
+-- '+'-joined string. Steps that themselves contained a '+' were already split
+-- apart when they were saved and stay that way.
+-- Run once against an existing Postgres database: psql $DATABASE_URL -f migrations/005_direction_steps.sql
+BEGIN;
+
+ALTER TABLE station_directions
+    ALTER COLUMN directions TYPE JSON
+    USING to_json(array_remove(string_to_array(COALESCE(directions, ''), '+'), ''));
+ALTER TABLE station_directions ALTER COLUMN directions SET NOT NULL;
+
+COMMIT;
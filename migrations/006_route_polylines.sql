@@ -0,0 +1,9 @@
+-- Saves the simplified shape of each route from its search's origin, as a Google
+-- encoded polyline, so the routes map doesn't have to ask for directions itself.
+-- Routes saved before this have no shape and are drawn as straight lines.
+-- Run once against an existing Postgres database: psql $DATABASE_URL -f migrations/006_route_polylines.sql
+BEGIN;
+
+ALTER TABLE route_data ADD COLUMN IF NOT EXISTS polyline TEXT;
+
+COMMIT;
@@ -1,8 +1,14 @@
+from datetime import datetime, timedelta
 from os import name
+from typing import Dict, List, Optional, Tuple
+
 from flask_sqlalchemy import SQLAlchemy # type: ignore
 from flask_bcrypt import Bcrypt # type: ignore
+from sqlalchemy.exc import SQLAlchemyError # type: ignore
 from sqlalchemy.orm import backref # type: ignore
 
+from spatial import STATION_INDEX
+
 
 db = SQLAlchemy()
 bcrypt = Bcrypt()
@@ -14,6 +20,17 @@ def connect_db(app):
     db.init_app(app)
 
 
+def bulk_insert(model, rows: List[Dict]) -> None:
+    """
+    Inserts a list of row dictionaries into the model's table with a single
+    executemany, skipping the ORM's per-object bookkeeping. With psycopg2,
+    SQLAlchemy sends this as one multi-row INSERT ... VALUES statement per
+    1000 rows. The caller commits.
+    """
+    if rows:
+        db.session.execute(model.__table__.insert(), rows)
+
+
 class User(db.Model): #type: ignore
     """Model class used to store information about
        users who register to use the app."""
@@ -24,11 +41,16 @@ class User(db.Model): #type: ignore
     password = db.Column(db.String, nullable=False)
     email = db.Column(db.String, unique=True, nullable=False)
 
-    searches = db.relationship('Search', backref='user')
-    origins = db.relationship('OriginInfo', backref='user')
-    stations = db.relationship('Station', backref='user')
-    directions = db.relationship('StationDirection', backref='user')
-    routes = db.relationship('RouteData', backref='user')
+    # the history relationships are queries, newest row first, so that
+    # touching them never loads a user's whole history
+    searches = db.relationship('Search', backref='user', lazy='dynamic', order_by='Search.id.desc()')
+    origins = db.relationship('OriginInfo', backref='user', lazy='dynamic', order_by='OriginInfo.id.desc()')
+    stations = db.relationship('Station', backref='user', lazy='dynamic', order_by='Station.id.desc()')
+    directions = db.relationship('StationDirection', backref='user', lazy='dynamic',
+                                 order_by='StationDirection.id.desc()')
+    routes = db.relationship('RouteData', backref='user', lazy='dynamic', order_by='RouteData.id.desc()')
+    search_sessions = db.relationship('SearchSession', backref='user', lazy='dynamic',
+                                      order_by='SearchSession.id.desc()')
 
 
     def __str__(self):
@@ -55,9 +77,52 @@ class User(db.Model): #type: ignore
         return False
 
 
+class SearchSession(db.Model): #type: ignore
+    """
+    One search a user made. The origin, stations, directions and routes
+    found for it all point back here, so a results page loads exactly one
+    search's rows, even if the user is searching in two tabs at once.
+    """
+    __tablename__ = 'search_sessions'
+    __table_args__ = (db.Index('ix_search_sessions_user_id_id', 'user_id', 'id'),)
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    board = db.Column(db.JSON)
+    board_fetched_at = db.Column(db.DateTime)
+
+    origin = db.relationship('OriginInfo', uselist=False)
+    stations = db.relationship('Station', order_by='Station.id')
+    directions = db.relationship('StationDirection', order_by='StationDirection.id')
+
+
+    def save_board(self, boards: Optional[List]) -> None:
+        """Keeps the HERE departures board found for this search."""
+        self.board = boards
+        self.board_fetched_at = datetime.utcnow() if boards else None
+
+
+    def fresh_board(self, max_age: int) -> Optional[List]:
+        """Returns the saved board, unless it is more than max_age seconds old."""
+        if not self.board or self.board_fetched_at + timedelta(seconds=max_age) < datetime.utcnow():
+            return None
+        return self.board
+
+
+    @classmethod
+    def for_user(cls, search_id: Optional[int], user_id: int):
+        """Returns the search with the given id, as long as it belongs to the user."""
+        if search_id is None:
+            return None
+        return cls.query.filter_by(id=search_id, user_id=user_id).first()
+
+
 class Search(db.Model): #type: ignore
     """Model that saves information from previous searches that users made."""
     __tablename__ = 'searches'
+    __table_args__ = (db.Index('ix_searches_user_id_id', 'user_id', 'id'),)
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     time = db.Column(db.String)
@@ -65,6 +130,8 @@ class Search(db.Model): #type: ignore
     destination = db.Column(db.String)
     website = db.Column(db.String)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='cascade'), nullable=False)
+    search_session_id = db.Column(db.Integer, db.ForeignKey('search_sessions.id', ondelete='CASCADE'), index=True)
+    station_id = db.Column(db.Integer, db.ForeignKey('stations.id', ondelete='CASCADE'), index=True)
 
 
     @property
@@ -82,73 +149,85 @@ class Search(db.Model): #type: ignore
 class OriginInfo(db.Model): #type: ignore
     """Table used to gather the data from the search string the user inputs."""
     __tablename__ = 'origins'
+    __table_args__ = (db.Index('ix_origins_user_id_id', 'user_id', 'id'),)
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     city_and_state = db.Column(db.String, nullable=False)
-    latitude = db.Column(db.String, nullable=False)
-    longitude = db.Column(db.String, nullable=False)
+    latitude = db.Column(db.Float, nullable=False)
+    longitude = db.Column(db.Float, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    search_session_id = db.Column(db.Integer, db.ForeignKey('search_sessions.id', ondelete='CASCADE'), index=True)
 
     
     @property
     def serialize(self):
         return {
             "address": self.city_and_state,
-            "latitude": float(self.latitude),
-            "longitude": float(self.longitude)
+            "latitude": self.latitude,
+            "longitude": self.longitude
         }
 
 
 class Station(db.Model): #type: ignore
     """Table used to gather the data for each station returned by the API."""
     __tablename__ = 'stations'
+    __table_args__ = (db.Index('ix_stations_user_id_id', 'user_id', 'id'),)
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String, nullable=False)
-    station_latitude = db.Column(db.String, nullable=False)
-    station_longitude = db.Column(db.String, nullable=False)
+    station_latitude = db.Column(db.Float, nullable=False)
+    station_longitude = db.Column(db.Float, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    search_session_id = db.Column(db.Integer, db.ForeignKey('search_sessions.id', ondelete='CASCADE'), index=True)
+
+    routes = db.relationship('RouteData', order_by='RouteData.id')
+    searches = db.relationship('Search', order_by='Search.id')
 
     @property
     def serialize(self):
         return {
             "name": self.name,
-            "station_latitude": float(self.station_latitude),
-            "station_longitude": float(self.station_longitude)
+            "station_latitude": self.station_latitude,
+            "station_longitude": self.station_longitude
         }
     
 
     @classmethod
-    def batch_commit(cls, data, id):
-        for d in data:
-            station = cls(name=data[d][0], station_latitude=str(data[d][1]), station_longitude=str(data[d][2]), user_id=id)
-            db.session.add(station)
+    def batch_commit(cls, data, id, search_id=None):
+        rows = [{"name": data[d][0], "station_latitude": data[d][1], "station_longitude": data[d][2],
+                 "user_id": id, "search_session_id": search_id} for d in data]
+        bulk_insert(cls, rows)
         db.session.commit()
 
+        # keep this worker's station index current; other workers pick
+        # the new rows up the next time they refresh their index
+        for d in data:
+            STATION_INDEX.add(data[d][0], data[d][1], data[d][2])
+
 
 class StationDirection(db.Model): #type: ignore
     """Table used to save all of the directions to the station"""
     __tablename__ = 'station_directions'
+    __table_args__ = (db.Index('ix_station_directions_user_id_id', 'user_id', 'id'),)
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    directions = db.Column(db.Text)
+    directions = db.Column(db.JSON, nullable=False, default=list)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    search_session_id = db.Column(db.Integer, db.ForeignKey('search_sessions.id', ondelete='CASCADE'), index=True)
 
     
     @classmethod
-    def batch_commit(cls, data, id):
-        for group in data:
-            temp = ''
-            for direction in group:
-                temp += f'{direction}+'
-            directions = cls(directions=temp, user_id=id)
-            db.session.add(directions)
+    def batch_commit(cls, data, id, search_id=None):
+        """Saves the list of steps to each station as one JSON array per station."""
+        rows = [{"directions": list(group), "user_id": id, "search_session_id": search_id} for group in data]
+        bulk_insert(cls, rows)
         db.session.commit()
 
 
 class RouteData(db.Model): #type: ignore
     """Table used to save all data for each route."""
     __tablename__ = 'route_data'
+    __table_args__ = (db.Index('ix_route_data_user_id_id', 'user_id', 'id'),)
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     time = db.Column(db.String, nullable=False)
     name = db.Column(db.String, nullable=False)
@@ -156,9 +235,13 @@ class RouteData(db.Model): #type: ignore
     headsign = db.Column(db.String, nullable=False)
     long_name = db.Column(db.String, nullable=False)
     website = db.Column(db.String, nullable=False)
-    latitude = db.Column(db.String, nullable=False)
-    longitude = db.Column(db.String, nullable=False)
+    latitude = db.Column(db.Float, nullable=False)
+    longitude = db.Column(db.Float, nullable=False)
+    # the shape of the route from the search's origin, as a Google encoded polyline
+    polyline = db.Column(db.Text)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    search_session_id = db.Column(db.Integer, db.ForeignKey('search_sessions.id', ondelete='CASCADE'), index=True)
+    station_id = db.Column(db.Integer, db.ForeignKey('stations.id', ondelete='CASCADE'), index=True)
 
 
     @property
@@ -169,6 +252,79 @@ class RouteData(db.Model): #type: ignore
             "destination": self.long_name,
             "website": self.website,
             "latitude": self.latitude,
-            "longitude": self.longitude
+            "longitude": self.longitude,
+            "polyline": self.polyline
         }
-    
\ No newline at end of file
+
+
+class GeocodeResult(db.Model): #type: ignore
+    """
+    Table shared by every worker that caches the coordinates Google returns
+    for a (normalized) search string. A search that Google could not find
+    is stored with no coordinates, so that misses can be cached as well.
+    """
+    __tablename__ = 'geocode_results'
+
+    search = db.Column(db.String, primary_key=True)
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+    @classmethod
+    def lookup(cls, search: str, ttl: int, miss_ttl: int):
+        """
+        Returns a (found, coordinates) pair for the search. found is False when
+        there is no fresh row for it. These methods are called from worker threads,
+        so they go through the engine rather than the scoped session, and a database
+        error is treated as a cache miss rather than breaking the search.
+        """
+        table = cls.__table__
+        try:
+            with db.engine.connect() as conn:
+                row = conn.execute(table.select().where(table.c.search == search)).first()
+        except SQLAlchemyError:
+            return False, None
+
+        if row is None:
+            return False, None
+
+        coords = None if row.latitude is None else (row.latitude, row.longitude)
+        max_age = timedelta(seconds=ttl if coords else miss_ttl)
+        if row.created_at + max_age < datetime.utcnow():
+            return False, None
+        return True, coords
+
+
+    @classmethod
+    def store(cls, search: str, coords: Optional[Tuple[float, float]]) -> None:
+        """Saves (or replaces) the coordinates found for the search."""
+        table = cls.__table__
+        latitude, longitude = coords if coords else (None, None)
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(table.delete().where(table.c.search == search))
+                conn.execute(table.insert().values(search=search, latitude=latitude, longitude=longitude,
+                                                   created_at=datetime.utcnow()))
+        except SQLAlchemyError:
+            pass
+
+
+class OutboundEmail(db.Model): #type: ignore
+    """
+    The outgoing mail queue. Emails are saved here by the request that
+    wants them sent, and sent later by the mail worker in sms.py, so a
+    message survives a restart and can be retried if sending fails.
+    """
+    __tablename__ = 'outbound_emails'
+    __table_args__ = (db.Index('ix_outbound_emails_status_next_attempt_at', 'status', 'next_attempt_at'),)
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    address = db.Column(db.String, nullable=False)
+    subject = db.Column(db.String, nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String, nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
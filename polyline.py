@@ -0,0 +1,119 @@
+from math import cos, radians
+from typing import List, Sequence, Tuple
+
+from geo import METERS_PER_DEGREE
+
+Point = Tuple[float, float]
+
+# HERE's flexible polylines use the url-safe base64 alphabet, five bits per character
+FLEXIBLE_ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_'
+_FLEXIBLE_VALUES = {char: value for value, char in enumerate(FLEXIBLE_ALPHABET)}
+FLEXIBLE_VERSION = 1
+
+
+def _flexible_varints(encoded: str) -> List[int]:
+    """The unsigned integers a flexible polyline is made of."""
+    values, value, shift = [], 0, 0
+    for char in encoded:
+        chunk = _FLEXIBLE_VALUES[char]
+        value |= (chunk & 0x1F) << shift
+        if chunk < 0x20:
+            values.append(value)
+            value, shift = 0, 0
+        else:
+            shift += 5
+    if shift:
+        raise ValueError('the polyline ends in the middle of a value')
+    return values
+
+
+def decode_flexible(encoded: str) -> List[Point]:
+    """
+    Decodes a HERE flexible polyline into (latitude, longitude) points.
+    A third dimension, such as elevation, is dropped if there is one.
+    """
+    values = _flexible_varints(encoded)
+    if len(values) < 2 or values[0] != FLEXIBLE_VERSION:
+        raise ValueError('not a flexible polyline')
+    header = values[1]
+    factor = 10 ** (header & 15)
+    dimensions = 3 if (header >> 4) & 7 else 2
+
+    deltas = values[2:]
+    if len(deltas) % dimensions:
+        raise ValueError('the polyline has an incomplete point')
+
+    points = []
+    latitude = longitude = 0
+    for i in range(0, len(deltas), dimensions):
+        # zigzag encoding: the lowest bit is the sign
+        lat_delta, lng_delta = [~value >> 1 if value & 1 else value >> 1 for value in deltas[i:i + 2]]
+        latitude += lat_delta
+        longitude += lng_delta
+        points.append((latitude / factor, longitude / factor))
+    return points
+
+
+def _offset_meters(point: Point, start: Point, scale: float) -> Tuple[float, float]:
+    return (point[1] - start[1]) * scale, (point[0] - start[0]) * METERS_PER_DEGREE
+
+
+def _distance_to_segment(point: Point, start: Point, end: Point, scale: float) -> float:
+    """How far a point is from the segment between start and end, in meters, on a local flat projection."""
+    px, py = _offset_meters(point, start, scale)
+    ex, ey = _offset_meters(end, start, scale)
+    length = ex * ex + ey * ey
+    t = max(0.0, min(1.0, (px * ex + py * ey) / length)) if length else 0.0
+    dx, dy = px - t * ex, py - t * ey
+    return (dx * dx + dy * dy) ** 0.5
+
+
+def simplify(points: Sequence[Point], tolerance: float) -> List[Point]:
+    """
+    Simplifies a line with the Douglas-Peucker algorithm: keeps the fewest
+    points for which no dropped point is more than tolerance meters away
+    from the simplified line. The first and last points are always kept.
+    """
+    if len(points) < 3:
+        return list(points)
+
+    # one longitude scale for the whole line is close enough at the size of a transit route
+    scale = METERS_PER_DEGREE * cos(radians(points[0][0]))
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        farthest, distance = first, 0.0
+        for i in range(first + 1, last):
+            d = _distance_to_segment(points[i], points[first], points[last], scale)
+            if d > distance:
+                farthest, distance = i, d
+        if distance > tolerance:
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def _encode_signed(value: int) -> str:
+    value = ~(value << 1) if value < 0 else value << 1
+    chars = []
+    while value >= 0x20:
+        chars.append(chr((0x20 | (value & 0x1F)) + 63))
+        value >>= 5
+    chars.append(chr(value + 63))
+    return ''.join(chars)
+
+
+def encode_google(points: Sequence[Point], precision: int = 5) -> str:
+    """Encodes (latitude, longitude) points in Google's encoded polyline format, which Leaflet plugins read."""
+    factor = 10 ** precision
+    encoded = []
+    last_lat = last_lng = 0
+    for latitude, longitude in points:
+        lat, lng = round(latitude * factor), round(longitude * factor)
+        encoded.append(_encode_signed(lat - last_lat))
+        encoded.append(_encode_signed(lng - last_lng))
+        last_lat, last_lng = lat, lng
+    return ''.join(encoded)
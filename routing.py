@@ -0,0 +1,47 @@
+from datetime import date
+from typing import Optional
+
+from gtfs import Feed, ScheduledDeparture, Stop
+
+# how far apart a live departure time and a scheduled one can be and still be the same trip
+TRIP_MATCH_SECONDS = 5 * 60
+MAX_CANDIDATES = 50
+
+
+def _headsign(value: str) -> str:
+    """HERE writes headsigns as 'To Devon/Clark', GTFS feeds usually as 'Devon/Clark'."""
+    value = value.strip().lower()
+    return value[3:].strip() if value.startswith('to ') else value
+
+
+def find_trip(feed: Feed, stop_id: str, route_name: str, headsign: str, departure: int,
+              day: Optional[date] = None, tolerance: int = TRIP_MATCH_SECONDS) -> Optional[ScheduledDeparture]:
+    """
+    Finds the scheduled trip behind a departure from a stop: the trip of the
+    route with that name and headsign, running on `day`, whose departure from
+    the stop is closest to `departure` (seconds after midnight), within
+    `tolerance`.
+    """
+    wanted = _headsign(headsign)
+    candidates = [
+        scheduled for scheduled in feed.next_departures(stop_id, departure - tolerance, MAX_CANDIDATES, day)
+        if scheduled.time <= departure + tolerance
+        and route_name in (scheduled.route.short_name, scheduled.route.long_name)
+        and (not wanted or not scheduled.trip.headsign or _headsign(scheduled.trip.headsign) == wanted)
+    ]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda scheduled: abs(scheduled.time - departure))
+
+
+def find_terminal_stop(feed: Feed, stop_id: str, route_name: str, headsign: str, departure: int,
+                       day: Optional[date] = None, tolerance: int = TRIP_MATCH_SECONDS) -> Optional[Stop]:
+    """
+    The stop where the trip behind a departure ends, read straight from the
+    feed's timetable. Returns None when no scheduled trip matches.
+    """
+    scheduled = find_trip(feed, stop_id, route_name, headsign, departure, day, tolerance)
+    if scheduled is None:
+        return None
+    stop_ids = feed.trip_stop_ids(scheduled.trip.trip_id)
+    return feed.stops.get(stop_ids[-1]) if stop_ids else None
@@ -1,27 +1,199 @@
+import random
 import smtplib
+import threading
+from datetime import datetime, timedelta
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from time import monotonic
+from typing import List, Optional
 
 from decouple import config
+from sqlalchemy import and_, or_ # type: ignore
+from sqlalchemy.exc import SQLAlchemyError # type: ignore
 
-EMAIL = config('EMAIL')
-PASSWORD = config('PASSWORD')
+from models import db, OutboundEmail
 
+SMTP_HOST = config('SMTP_HOST', default='smtp.gmail.com')
+SMTP_PORT = config('SMTP_PORT', default=587, cast=int)
+SMTP_USE_TLS = config('SMTP_USE_TLS', default=True, cast=bool)
+SUBJECT = 'Ride Finder - Reset Password'
 
-def send(message, address):
-    server = smtplib.SMTP('smtp.gmail.com', 587)
-    server.ehlo()
-    server.starttls()
-    server.login(EMAIL, PASSWORD)
+# how the mail worker polls the queue, retries failures and lets go of idle connections
+POLL_INTERVAL = config('MAIL_POLL_INTERVAL', default=5.0, cast=float)
+IDLE_TIMEOUT = config('MAIL_IDLE_TIMEOUT', default=60.0, cast=float)
+MAX_ATTEMPTS = config('MAIL_MAX_ATTEMPTS', default=5, cast=int)
+RETRY_BACKOFF = config('MAIL_RETRY_BACKOFF', default=30.0, cast=float)
+# an email left 'sending' this long (i.e. by a worker that died) is picked up again
+SENDING_TIMEOUT = config('MAIL_SENDING_TIMEOUT', default=300, cast=int)
 
+
+def send(message, address, subject=SUBJECT):
+    """
+    Queues an email to be sent by the background mail worker and returns
+    right away. The email is saved to the database first, so it is still
+    sent if this process stops before the worker gets to it.
+    """
+    db.session.add(OutboundEmail(address=address, subject=subject, body=message))
+    db.session.commit()
+    worker = get_worker()
+    worker.start_once()
+    worker.notify()
+
+
+def build_message(message, address, subject=SUBJECT, sender=None):
     msg = MIMEMultipart()
-    msg['From'] = EMAIL
+    msg['From'] = sender or config('EMAIL')
     msg['To'] = address
-    msg['Subject'] = 'Ride Finder - Reset Password'
+    msg['Subject'] = subject
     msg.attach(MIMEText(message, 'plain'))
-    sms = msg.as_string()
+    return msg.as_string()
+
+
+class MailWorker(threading.Thread):
+    """
+    Background thread that sends the queued emails. It keeps one
+    authenticated SMTP connection open while there is mail to send,
+    reconnecting if the server drops it, and retries failed emails with
+    exponential backoff until MAX_ATTEMPTS is reached.
+    """
+    def __init__(self, host: str = SMTP_HOST, port: int = SMTP_PORT, use_tls: bool = SMTP_USE_TLS,
+                 username: Optional[str] = None, password: Optional[str] = None, sender: str = '') -> None:
+        super().__init__(name='mail-worker', daemon=True)
+        self.host = host
+        self.port = port
+        self.use_tls = use_tls
+        self.username = username
+        self.password = password
+        self.sender = sender
+        self.connections_opened = 0
+        self._server: Optional[smtplib.SMTP] = None
+        self._last_used = 0.0
+        self._wake = threading.Event()
+        self._start_lock = threading.Lock()
+
+
+    def start_once(self) -> None:
+        """Starts the worker thread, unless it is already running."""
+        with self._start_lock:
+            if not self.is_alive():
+                self.start()
+
+
+    def notify(self) -> None:
+        """Wakes the worker up to send newly queued mail."""
+        self._wake.set()
+
+
+    def run(self) -> None:
+        while True:
+            try:
+                self.process_due()
+            except SQLAlchemyError:
+                db.session.rollback()
+            finally:
+                db.session.remove()
+
+            self._wake.wait(POLL_INTERVAL)
+            self._wake.clear()
+            if self._server is not None and monotonic() - self._last_used > IDLE_TIMEOUT:
+                self.close()
+
+
+    def process_due(self) -> int:
+        """Sends every email that is due. Returns how many were sent."""
+        sent = 0
+        for email_id in self._claim_due():
+            email = OutboundEmail.query.get(email_id)
+            email.attempts += 1
+            try:
+                self._send(email.address, build_message(email.body, email.address, email.subject, self.sender))
+            except (smtplib.SMTPException, OSError) as e:
+                self.close()
+                email.last_error = str(e)
+                if email.attempts >= MAX_ATTEMPTS:
+                    email.status = 'failed'
+                else:
+                    delay = RETRY_BACKOFF * 2 ** (email.attempts - 1)
+                    email.status = 'pending'
+                    email.next_attempt_at = datetime.utcnow() + timedelta(seconds=random.uniform(delay / 2, delay))
+            else:
+                email.status = 'sent'
+                sent += 1
+            db.session.commit()
+        return sent
+
+
+    def _claim_due(self) -> List[int]:
+        """
+        Marks the emails that are due as 'sending' and returns their ids. The
+        conditional update means that when several processes share the queue,
+        each email is only claimed by one of them.
+        """
+        now = datetime.utcnow()
+        abandoned = now - timedelta(seconds=SENDING_TIMEOUT)
+        due = OutboundEmail.query.filter(or_(
+            and_(OutboundEmail.status == 'pending', OutboundEmail.next_attempt_at <= now),
+            and_(OutboundEmail.status == 'sending', OutboundEmail.next_attempt_at <= abandoned)
+        )).order_by(OutboundEmail.id).all()
+
+        claimed = []
+        for email in due:
+            updated = OutboundEmail.query.filter_by(id=email.id, status=email.status, attempts=email.attempts) \
+                                         .update({"status": "sending", "next_attempt_at": now},
+                                                 synchronize_session=False)
+            if updated:
+                claimed.append(email.id)
+        db.session.commit()
+        return claimed
+
+
+    def _send(self, address: str, message: str) -> None:
+        """Sends on the open connection, reconnecting once if the server has dropped it."""
+        try:
+            self._connection().sendmail(self.sender, address, message)
+        except smtplib.SMTPServerDisconnected:
+            self.close()
+            self._connection().sendmail(self.sender, address, message)
+        self._last_used = monotonic()
+
+
+    def _connection(self) -> smtplib.SMTP:
+        if self._server is None:
+            server = smtplib.SMTP(self.host, self.port, timeout=30)
+            server.ehlo()
+            if self.use_tls:
+                server.starttls()
+                server.ehlo()
+            if self.username and self.password:
+                server.login(self.username, self.password)
+            self._server = server
+            self.connections_opened += 1
+        return self._server
+
+
+    def close(self) -> None:
+        """Closes the SMTP connection, if one is open."""
+        if self._server is None:
+            return
+        try:
+            self._server.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self._server = None
+
+
+_WORKER: Optional[MailWorker] = None
+_WORKER_LOCK = threading.Lock()
 
 
-    server.sendmail(EMAIL, address, sms)
-    msg = ''
-    server.quit()
\ No newline at end of file
+def get_worker() -> MailWorker:
+    """
+    The mail worker, created the first time mail is sent, with the
+    account in EMAIL and PASSWORD, so importing this module doesn't
+    need the credentials.
+    """
+    global _WORKER
+    with _WORKER_LOCK:
+        if _WORKER is None:
+            _WORKER = MailWorker(username=config('EMAIL'), password=config('PASSWORD'), sender=config('EMAIL'))
+    return _WORKER
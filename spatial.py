@@ -0,0 +1,85 @@
+import threading
+from collections import defaultdict
+from math import ceil, cos, radians
+from typing import Dict, Iterable, List, NamedTuple, Set, Tuple
+
+from geo import METERS_PER_DEGREE, haversine_meters
+
+
+class StationPoint(NamedTuple):
+    name: str
+    latitude: float
+    longitude: float
+
+
+class StationIndex:
+    """
+    An in-memory grid index of every known station. Stations are bucketed
+    into cells of cell_size degrees, so a radius or nearest-neighbour lookup
+    only has to measure the stations in the handful of cells around the
+    point. The same station saved by many users is only indexed once.
+    """
+    def __init__(self, cell_size: float = 0.01) -> None:
+        self.cell_size = cell_size
+        self.last_id = 0
+        self.refreshed_at = 0.0
+        self._cells: Dict[Tuple[int, int], List[StationPoint]] = defaultdict(list)
+        self._seen: Set[Tuple[str, float, float]] = set()
+        self._lock = threading.Lock()
+
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+
+    def _cell(self, latitude: float, longitude: float) -> Tuple[int, int]:
+        return int(latitude // self.cell_size), int(longitude // self.cell_size)
+
+
+    def add(self, name: str, latitude: float, longitude: float) -> None:
+        """Adds a station, unless it is already in the index."""
+        key = (name, round(latitude, 6), round(longitude, 6))
+        with self._lock:
+            if key in self._seen:
+                return
+            self._seen.add(key)
+            self._cells[self._cell(latitude, longitude)].append(StationPoint(name, latitude, longitude))
+
+
+    def add_all(self, rows: Iterable[Tuple]) -> None:
+        """Adds (id, name, latitude, longitude) rows and remembers the highest id seen."""
+        for station_id, name, latitude, longitude in rows:
+            self.add(name, latitude, longitude)
+            self.last_id = max(self.last_id, station_id)
+
+
+    def _candidates(self, latitude: float, longitude: float, rings: int) -> List[StationPoint]:
+        """Every station in the square of cells `rings` cells out from the point's cell."""
+        row, col = self._cell(latitude, longitude)
+        found: List[StationPoint] = []
+        with self._lock:
+            for i in range(row - rings, row + rings + 1):
+                for j in range(col - rings, col + rings + 1):
+                    found.extend(self._cells.get((i, j), ()))
+        return found
+
+
+    def _rings_for(self, latitude: float, meters: float) -> int:
+        """How many rings of cells are needed to cover the radius at this latitude."""
+        lng_cell_meters = self.cell_size * METERS_PER_DEGREE * max(cos(radians(latitude)), 0.01)
+        return max(1, ceil(meters / lng_cell_meters))
+
+
+    def within(self, latitude: float, longitude: float, meters: float) -> List[StationPoint]:
+        """The stations within the given number of meters, closest first."""
+        candidates = self._candidates(latitude, longitude, self._rings_for(latitude, meters))
+        distances = [(haversine_meters(latitude, longitude, s.latitude, s.longitude), s) for s in candidates]
+        return [s for distance, s in sorted(distances, key=lambda pair: pair[0]) if distance <= meters]
+
+
+    def nearest(self, latitude: float, longitude: float, k: int, max_meters: float) -> List[StationPoint]:
+        """The k closest stations that are no more than max_meters away."""
+        return self.within(latitude, longitude, max_meters)[:k]
+
+
+STATION_INDEX = StationIndex()
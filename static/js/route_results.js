@@ -1,3 +1,27 @@
+const decodePolyline = (encoded) => {
+    // Decodes a Google encoded polyline into [latitude, longitude] pairs.
+    let points = [];
+    let index = 0, lat = 0, lng = 0;
+
+    while (index < encoded.length) {
+        let deltas = [];
+        for (let d = 0; d < 2; d++) {
+            let result = 0, shift = 0, byte;
+            do {
+                byte = encoded.charCodeAt(index++) - 63;
+                result |= (byte & 0x1f) << shift;
+                shift += 5;
+            } while (byte >= 0x20);
+            deltas.push(result & 1 ? ~(result >> 1) : result >> 1);
+        }
+        lat += deltas[0];
+        lng += deltas[1];
+        points.push([lat / 1e5, lng / 1e5]);
+    }
+    return points;
+};
+
+
 class MakeSingleMap {
     // This class generates one map with all of the different
     // route markers for each station.
@@ -8,7 +32,10 @@ class MakeSingleMap {
     async createMap() {
         // Collects all the data needed to create the map and
         // plot coordinates on it.
-        let data = await axios.get('https://find-rides.herokuapp.com/get_routes');
+        // asks for the routes of this page's search and station
+        let params = new URLSearchParams(window.location.search);
+        params.set('station', window.location.pathname.split('/')[2]);
+        let data = await axios.get(`https://find-rides.herokuapp.com/api/v1/routes?${params}`);
         let routes = data.data;
         let {latitude, longitude} = routes[1];
         let destination_coords = routes.slice(-1)[0]
@@ -26,17 +53,29 @@ class MakeSingleMap {
             draggable: false
         }).bindPopup(origin).addTo(map);
 
+        // the shape of each route comes with the data, so nothing is routed here;
+        // a route without one is drawn as a straight line to its destination
+        let shapes = [];
         for (let i = 0; i < destination_coords.length; i++) {
             let [lat, lng] = [...destination_coords[i]]
-            
-            L.mapquest.directions().route({
-                start: [latitude, longitude],
-                end: [lat, lng],
-                options: {
-                    timeOverage: 25,
-                    maxRoutes: 1,
-                }
-            });
+            let encoded = routes[0][i] && routes[0][i].polyline;
+            let points = encoded ? decodePolyline(encoded) : [[latitude, longitude], [lat, lng]];
+
+            shapes.push(L.polyline(points, {
+                color: '#2a6ebb',
+                weight: 4,
+                opacity: 0.8,
+                dashArray: encoded ? null : '6 8'
+            }).addTo(map));
+
+            L.marker([lat, lng], {
+                icon: L.mapquest.icons.marker({primaryColor: '#2a6ebb'}),
+                draggable: false
+            }).bindPopup(routes[0][i] ? routes[0][i].destination : '').addTo(map);
+        }
+
+        if (shapes.length) {
+            map.fitBounds(L.featureGroup(shapes).getBounds(), {padding: [20, 20]});
         }
 
         map.addControl(L.mapquest.control());
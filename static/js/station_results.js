@@ -25,7 +25,8 @@ class MapMaker {
         // Gathers necessary data and uses it to render a map
         // in browser with a point to show the location of the
         // station.
-        let data = await axios.get('https://find-rides.herokuapp.com/get_stations');
+        // the page's query string says which search the stations belong to
+        let data = await axios.get(`https://find-rides.herokuapp.com/api/v1/stations${window.location.search}`);
         let routes = data.data;
         let maps = this.mapArray();
 
@@ -1,11 +1,29 @@
-from unittest import TestCase
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
 
 from flask_bcrypt import Bcrypt
-from flask import session, render_template, Flask
+from flask import session, render_template, Flask, Markup
 from decouple import config
-
-from app import app, MAP_ARRAY
-from models import db, User, Search, OriginInfo
+from sqlalchemy import event, inspect
+
+import app as ride_finder
+import async_transit as at
+from app import app, MAP_ARRAY, STATION_CARD_CACHE
+from models import db, User, Search, OriginInfo, RouteData, GeocodeResult, Station, SearchSession, StationDirection, OutboundEmail
+import cassette
+import get_routes as gr
+import instrumentation
+import sms
+from http_client import CLIENT, MAX_RETRIES, RETRY_BUDGET
+from spatial import StationIndex
+
+try:
+    from aiosmtpd.controller import Controller
+except ImportError:
+    Controller = None
 from forms import RegistrationForm
 
 
@@ -17,6 +35,17 @@ db.drop_all()
 db.create_all()
 
 
+def setUpModule():
+    global CASSETTE
+    CASSETTE = cassette.install()
+
+
+def tearDownModule():
+    CLIENT.mount(None)
+    if CASSETTE and CASSETTE.mode == 'record':
+        CASSETTE.save()
+
+
 def create_app(cfg=None):
     app = Flask(__name__)
     return app
@@ -77,6 +106,21 @@ class RideFinderTestCase(TestCase):
         ]
     
 
+    def mock_board(self):
+        return [
+            {
+                'place': {'name': 'Union Station', 'location': {'lat': 41.8787, 'lng': -87.6403}},
+                'departures': [
+                    {
+                        'time': '2021-08-23T17:05:00-05:00',
+                        'transport': {'mode': 'regionalTrain', 'name': 'BNSF', 'headsign': 'Aurora'},
+                        'agency': {'name': 'Metra', 'website': 'https://metrarail.com'}
+                    }
+                ]
+            }
+        ]
+    
+
     def remove_from_db(self, db_item):
         db.session.delete(db_item)
         db.session.commit()
@@ -182,7 +226,10 @@ class RideFinderTestCase(TestCase):
         directions = self.mock_directions()
         @app2.route('/search/results')
         def show_stations():
-            return render_template('station_results.html', routes=stations, directions=directions, maps=MAP_ARRAY)
+            cards = [Markup(render_template('_station_card.html', route=station, directions=directions[idx],
+                                            map_id=MAP_ARRAY[idx], idx=idx, search_id=1))
+                     for idx, station in enumerate(stations)]
+            return render_template('station_results.html', cards=cards)
         with app2.test_client() as client:
             resp = client.get('/search/results')
             self.assertEqual(resp.status_code, 200)
@@ -218,6 +265,373 @@ class RideFinderTestCase(TestCase):
         self.remove_from_db(origin)
     
 
+    def test_save_route_data_to_db(self):
+        """
+        Are all of the routes saved in the order they were given, each with
+        the coordinates resolved for it, and is the shape of the route to
+        those coordinates only fetched once?
+        """
+        origin = self.create_origin_object()
+        user = User.query.get(origin.user_id)
+        routes = [gr.Departure(*route) for route in self.mock_route_information()] * 3
+        coords_dict = {"latitude": origin.latitude, "longitude": origin.longitude}
+
+        def fake_resolve(route, city_and_state, coords, stop_id=None):
+            return 41.8787, -87.6403
+
+        shapes = []
+        def fake_geometry(start, end):
+            shapes.append(end)
+            return '_p~iF~ps|U_ulLnnqC'
+
+        gr.ROUTE_GEOMETRY_CACHE.clear()
+        with patch.object(gr, 'resolve_destination_coordinates', fake_resolve), \
+             patch.object(gr, 'get_route_geometry', fake_geometry):
+            names = gr.save_route_data_to_db(routes, coords_dict, user, origin)
+
+        self.assertEqual(names, ['Crescent'] * 3)
+        saved = RouteData.query.filter_by(user_id=user.id).all()
+        self.assertEqual(len(saved), 3)
+        self.assertEqual(float(saved[0].latitude), 41.8787)
+        self.assertEqual([r.polyline for r in saved], ['_p~iF~ps|U_ulLnnqC'] * 3)
+        self.assertEqual(shapes, [(41.8787, -87.6403)])
+        self.assertEqual(Search.query.filter_by(user_id=user.id).count(), 3)
+        RouteData.query.delete()
+        db.session.commit()
+        self.remove_from_db(origin)
+    
+
+    def test_geocode_cache(self):
+        """
+        Is a search string only sent to Google once, whether it is found
+        in memory or in the shared table, and are misses cached too?
+        """
+        calls = []
+
+        def fake_geocode(search):
+            calls.append(search)
+            if 'nowhere' in search:
+                return []
+            return [{'geometry': {'location': {'lat': 41.8787, 'lng': -87.6403}}}]
+
+        # the shared table is written through its own connection
+        db.session.commit()
+        gr.GEOCODE_CACHE.clear()
+        with patch.object(gr.get_gmaps(), 'geocode', fake_geocode):
+            self.assertEqual(gr.get_lat_and_long('Union Station, Chicago IL'), (41.8787, -87.6403))
+            self.assertEqual(gr.get_lat_and_long('  union station,  chicago il'), (41.8787, -87.6403))
+            gr.GEOCODE_CACHE.clear()
+            self.assertEqual(gr.get_lat_and_long('Union Station, Chicago IL'), (41.8787, -87.6403))
+            self.assertIsNone(gr.get_lat_and_long('nowhere at all'))
+            self.assertIsNone(gr.get_lat_and_long('nowhere at all'))
+
+        self.assertEqual(len(calls), 2)
+        GeocodeResult.query.delete()
+        db.session.commit()
+        gr.GEOCODE_CACHE.clear()
+    
+
+    def test_gmaps_retries_follow_transit_client(self):
+        """Does the Google Maps client give up on the same budget as TransitClient?"""
+        gmaps = gr.get_gmaps()
+        self.assertEqual(gmaps.retry_timeout, timedelta(seconds=RETRY_BUDGET))
+        self.assertEqual(gmaps.retry_over_query_limit, MAX_RETRIES > 0)
+    
+
+    def test_station_coordinates_are_numbers(self):
+        """Are saved station coordinates stored and read back as numbers?"""
+        user = self.create_user()
+        Station.batch_commit({0: ['Union Station', 41.8787, -87.6403]}, user.id)
+
+        station = Station.query.filter_by(name='Union Station').one()
+        self.assertIsInstance(station.station_latitude, float)
+        self.assertEqual(station.station_longitude, -87.6403)
+        Station.query.delete()
+        db.session.commit()
+    
+
+    def test_local_stations_need_coverage(self):
+        """
+        Are stations only found in the local index near the origin of a
+        search whose stations HERE listed, and not just because one
+        known station happens to be nearby?
+        """
+        user = self.create_user()
+        Station.batch_commit({0: ['Union Station', 41.8787, -87.6403]}, user.id)
+
+        with patch.object(gr, 'STATION_INDEX', StationIndex()), patch.object(gr, 'COVERAGE_INDEX', StationIndex()), \
+             patch.object(gr, 'get_feed', lambda: None):
+            self.assertEqual(gr.find_local_stations_near(41.8789, -87.6400), {})
+
+            search = SearchSession(user_id=user.id)
+            db.session.add(search)
+            db.session.flush()
+            db.session.add(OriginInfo(city_and_state='Chicago, IL', latitude=41.8790, longitude=-87.6401,
+                                      user_id=user.id, search_session_id=search.id))
+            search.save_board(self.mock_board())
+            db.session.commit()
+
+            gr.STATION_INDEX.refreshed_at = 0
+            self.assertEqual(gr.find_local_stations_near(41.8789, -87.6400), {0: ['Union Station', 41.8787, -87.6403]})
+            # a kilometer away isn't covered by that search
+            self.assertEqual(gr.find_local_stations_near(41.8879, -87.6400), {})
+
+        for model in (Station, OriginInfo, SearchSession):
+            model.query.delete()
+        db.session.commit()
+    
+
+    def run_searches(self, client, *found):
+        """Posts one search for every dict of stations given, and returns the ids of the searches."""
+        for stations in found:
+            with patch.object(gr, 'get_lat_and_long', lambda address: (41.8789, -87.6400)), \
+                 patch.object(gr, 'find_stations_near', lambda lat, lng: (stations, self.mock_board())), \
+                 patch.object(gr, 'get_directions_to_stations', lambda start, ends: [['Walk north', 'Take I-90 + I-94']] * len(ends)):
+                resp = client.post('/search', data={"street_address": "Chicago, IL"})
+            self.assertEqual(resp.status_code, 302)
+        return [s.id for s in SearchSession.query.order_by(SearchSession.id)][-len(found):]
+    
+
+    def count_statements(self, request):
+        """Makes the request, and returns its response and the statements it ran."""
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            resp = request()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        return resp, statements
+    
+
+    def delete_searches(self):
+        for model in (Search, RouteData, StationDirection, Station, OriginInfo, SearchSession):
+            model.query.delete()
+        db.session.commit()
+        STATION_CARD_CACHE.clear()
+    
+
+    def test_search_results_per_search(self):
+        """
+        Does each search get its own search session, so that the results
+        of an earlier search can still be loaded by its id?
+        """
+        user = self.make_user()
+        with app.test_client() as client:
+            with client.session_transaction() as sesh:
+                sesh["username"] = user.username
+            first_id, second_id = self.run_searches(client, {0: ['Union Station', 41.8787, -87.6403]},
+                                                    {0: ['Clinton', 41.8756, -87.6412], 1: ['Quincy', 41.8788, -87.6338]})
+
+            resp = client.get(f'/get_stations?search={first_id}')
+            self.assertEqual(resp.get_json(), {"0": ['Union Station', 41.8787, -87.6403]})
+            resp = client.get('/get_stations')
+            self.assertEqual(len(resp.get_json()), 2)
+            resp = client.get(f'/search/results?search={second_id}')
+            self.assertIn('Quincy', resp.get_data(as_text=True))
+            self.assertIn('<p>Take I-90 + I-94</p>', resp.get_data(as_text=True))
+        self.delete_searches()
+    
+
+    def test_station_cards_are_cached(self):
+        """
+        Does refreshing a results page reuse its rendered station cards, and
+        does a new search only drop the cards of the session's current search?
+        """
+        user = self.make_user()
+        with app.test_client() as client:
+            with client.session_transaction() as sesh:
+                sesh["username"] = user.username
+            first_id, second_id = self.run_searches(client, {0: ['Union Station', 41.8787, -87.6403]},
+                                                    {0: ['Clinton', 41.8756, -87.6412], 1: ['Quincy', 41.8788, -87.6338]})
+
+            resp = client.get(f'/search/results?search={second_id}')
+            resp2, statements = self.count_statements(lambda: client.get(f'/search/results?search={second_id}'))
+            self.assertEqual(resp2.get_data(as_text=True), resp.get_data(as_text=True))
+            for table in (Station.__tablename__, StationDirection.__tablename__):
+                self.assertFalse([s for s in statements if f'FROM {table}' in s])
+
+            # the second search is the session's current one; the first may still be open in another tab
+            client.get(f'/search/results?search={first_id}')
+            self.run_searches(client, {0: ['Union Station', 41.8787, -87.6403]})
+            self.assertIsNone(STATION_CARD_CACHE.get((second_id, 0)))
+            self.assertIsNotNone(STATION_CARD_CACHE.get((first_id, 0)))
+        self.delete_searches()
+    
+
+    def test_map_data_etags(self):
+        """
+        Are repeat map loads answered with a 304 without any queries, while
+        another search's map data is sent again?
+        """
+        user = self.make_user()
+        with app.test_client() as client:
+            with client.session_transaction() as sesh:
+                sesh["username"] = user.username
+            first_id, second_id = self.run_searches(client, {0: ['Union Station', 41.8787, -87.6403]},
+                                                    {0: ['Clinton', 41.8756, -87.6412]})
+
+            resp = client.get(f'/api/v1/stations?search={first_id}')
+            self.assertIn('private', resp.headers['Cache-Control'])
+            resp2, statements = self.count_statements(
+                lambda: client.get(f'/api/v1/stations?search={first_id}', headers={'If-None-Match': resp.headers['ETag']}))
+            self.assertEqual(resp2.status_code, 304)
+            self.assertEqual(statements, [])
+            resp3 = client.get(f'/api/v1/stations?search={second_id}', headers={'If-None-Match': resp.headers['ETag']})
+            self.assertEqual(resp3.status_code, 200)
+        self.delete_searches()
+    
+
+    def test_station_routes_reuse_saved_board(self):
+        """
+        Does a station's routes page use the board saved with its search instead
+        of asking HERE again, and send each route's destination and shape to the map?
+        """
+        user = self.make_user()
+
+        def no_upstream_call(lat, lng):
+            raise AssertionError('the saved board should have been used')
+
+        gr.ROUTE_GEOMETRY_CACHE.clear()
+        with app.test_client() as client:
+            with client.session_transaction() as sesh:
+                sesh["username"] = user.username
+            search_id, = self.run_searches(client, {0: ['Union Station', 41.8787, -87.6403]})
+
+            with patch.object(gr, '_get_routes_and_stations', no_upstream_call), \
+                 patch.object(gr, 'resolve_destination_coordinates', lambda route, city, coords, stop_id=None: (41.76, -88.32)), \
+                 patch.object(gr, 'get_route_geometry', lambda start, end: 'ukw~Fzvn|O~qAbtfE'):
+                resp = client.get(f'/stations/0/routes?search={search_id}')
+            self.assertIn('Aurora', resp.get_data(as_text=True))
+
+            resp = client.get(f'/get_routes?search={search_id}&station=0')
+            self.assertEqual(resp.get_json()[-1], [[41.76, -88.32]])
+            self.assertEqual(resp.get_json()[0][0]['polyline'], 'ukw~Fzvn|O~qAbtfE')
+        self.delete_searches()
+    
+
+    @skipUnless(at.httpx and ride_finder.sync_to_async, 'needs httpx and flask[async]')
+    def test_async_views(self):
+        """
+        With ASYNC_VIEWS on, do a search and a station's routes page make their
+        upstream calls over the shared async client, and save the same data as
+        the blocking views?
+        """
+        user = self.make_user()
+        calls = []
+
+        def handler(request):
+            calls.append(request.url.path)
+            if request.url.path.endswith('/geocode/json'):
+                body = {"results": [{"geometry": {"location": {"lat": 41.8789, "lng": -87.6400}}}]}
+            elif request.url.path.endswith('/directions/json'):
+                body = {"routes": [{"legs": [{"steps": [{"html_instructions": "Walk <b>north</b>"}]}]}]}
+            elif request.url.path == '/v8/departures':
+                body = {"boards": self.mock_board()}
+            else:
+                body = {"routes": [{"sections": [{"arrival": {"place": {"location": {"lat": 41.76, "lng": -88.32}}},
+                                                  "polyline": 'BFyx5xJ-ri1BzIhaxL7Y'}]}]}
+            return at.httpx.Response(200, json=body)
+
+        client = at.AsyncTransitClient(transport=at.httpx.MockTransport(handler))
+        async_views = {'views.search_stations': ride_finder.search_stations_async,
+                       'views.show_route_results': ride_finder.show_route_results_async}
+        for cache in (gr.GEOCODE_CACHE, gr.BOARD_CACHE, gr.DIRECTIONS_CACHE, gr.ROUTE_GEOMETRY_CACHE):
+            cache.clear()
+
+        with patch.dict(app.view_functions, async_views), patch.object(ride_finder, 'at', at, create=True), \
+             patch.object(at, 'ASYNC_CLIENT', client), patch.object(gr, 'STATION_INDEX', StationIndex()), \
+             patch.object(gr, 'COVERAGE_INDEX', StationIndex()), app.test_client() as browser:
+            with browser.session_transaction() as sesh:
+                sesh["username"] = user.username
+
+            resp = browser.post('/search', data={"street_address": "Union Station, Chicago, IL"})
+            self.assertEqual(resp.status_code, 302)
+            search_id = SearchSession.query.order_by(SearchSession.id.desc()).first().id
+            resp = browser.get(f'/search/results?search={search_id}')
+            self.assertIn('Union Station', resp.get_data(as_text=True))
+            self.assertIn('<p>Walk north</p>', resp.get_data(as_text=True))
+
+            # the routes page reuses the board saved with the search
+            resp = browser.get(f'/stations/0/routes?search={search_id}')
+            self.assertIn('Aurora', resp.get_data(as_text=True))
+            resp = browser.get(f'/get_routes?search={search_id}&station=0')
+            self.assertEqual(resp.get_json()[-1], [[41.76, -88.32]])
+            self.assertIsNotNone(resp.get_json()[0][0]['polyline'])
+            at.LOOP.run(client.aclose(), timeout=5)
+
+        self.assertEqual(calls.count('/v8/departures'), 1)
+        self.assertEqual(calls.count('/maps/api/directions/json'), 1)
+        for model in (Search, RouteData, StationDirection, Station, OriginInfo, SearchSession, GeocodeResult):
+            model.query.delete()
+        db.session.commit()
+        for cache in (gr.GEOCODE_CACHE, gr.BOARD_CACHE, gr.DIRECTIONS_CACHE, gr.ROUTE_GEOMETRY_CACHE):
+            cache.clear()
+    
+
+    @skipUnless(Controller, 'aiosmtpd is not installed')
+    def test_reset_email_is_queued_and_sent(self):
+        """
+        Does the reset page queue the email instead of sending it, and does
+        the mail worker then send queued emails over one SMTP connection?
+        """
+        class Handler:
+            def __init__(self):
+                self.messages = []
+
+            async def handle_DATA(self, server, session, envelope):
+                self.messages.append(envelope)
+                return '250 OK'
+
+        user = self.make_user()
+        handler = Handler()
+        controller = Controller(handler, hostname='127.0.0.1', port=8025)
+        controller.start()
+        worker = sms.MailWorker(host='127.0.0.1', port=8025, use_tls=False, username=None, password=None,
+                                sender='noreply@ridefinder.test')
+        try:
+            with patch.object(sms.get_worker(), 'start_once'), app.test_client() as client:
+                resp = client.post('/reset/email', data={"email": user.email})
+                resp2 = client.post('/reset/email', data={"email": user.email})
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(OutboundEmail.query.filter_by(status='pending').count(), 2)
+            self.assertEqual(handler.messages, [])
+
+            self.assertEqual(worker.process_due(), 2)
+            self.assertEqual(len(handler.messages), 2)
+            self.assertEqual(handler.messages[0].rcpt_tos, [user.email])
+            self.assertEqual(worker.connections_opened, 1)
+            self.assertEqual(OutboundEmail.query.filter_by(status='sent').count(), 2)
+        finally:
+            worker.close()
+            controller.stop()
+            OutboundEmail.query.delete()
+            db.session.commit()
+    
+
+    def test_send_mail_command(self):
+        """
+        Does 'flask send-mail' send the queued emails, including one left
+        'sending' by a worker that stopped?
+        """
+        stuck = datetime.utcnow() - timedelta(seconds=sms.SENDING_TIMEOUT + 1)
+        db.session.add(OutboundEmail(address='joey@gmail.com', subject='Reset', body='hi'))
+        db.session.add(OutboundEmail(address='kim08@gmail.com', subject='Reset', body='hi',
+                                     status='sending', next_attempt_at=stuck))
+        db.session.commit()
+
+        worker = sms.MailWorker(sender='noreply@ridefinder.test')
+        with patch.object(ride_finder, 'get_worker', lambda: worker), patch.object(worker, '_send') as sent:
+            result = app.test_cli_runner().invoke(args=['send-mail', '--once'])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('Sent 2 emails.', result.output)
+        self.assertEqual(sorted(call.args[0] for call in sent.call_args_list), ['joey@gmail.com', 'kim08@gmail.com'])
+        self.assertEqual(OutboundEmail.query.filter_by(status='sent').count(), 2)
+        OutboundEmail.query.delete()
+        db.session.commit()
+    
+
     def test_check_email_exists_route(self):
         """Test to check that the 'Reset Password' page works and asks for an email address."""
         with app.test_client() as client:
@@ -237,3 +651,79 @@ class RideFinderTestCase(TestCase):
             self.assertIn('Reset your password.', resp.get_data(as_text=True))
 
 
+    def test_server_timing_and_metrics(self):
+        """
+        Are the upstream calls and database statements of a request, including
+        the ones made on worker threads, reported in its Server-Timing header
+        and in the /metrics histograms?
+        """
+        user = self.make_user()
+        for cache in (gr.GEOCODE_CACHE, gr.BOARD_CACHE, gr.DIRECTIONS_CACHE):
+            cache.clear()
+
+        # an empty station index, so the stations are found on the departures board
+        with cassette.use_cassette('fixtures/cassettes/chicago.json', match_endpoint=True), app.test_client() as client, \
+             patch.object(gr, 'STATION_INDEX', StationIndex()):
+            with client.session_transaction() as sesh:
+                sesh["username"] = user.username
+            resp = client.post('/search', data={"street_address": "Union Station, Chicago, IL"})
+
+            timing = resp.headers['Server-Timing']
+            for name in ('geocode', 'departures', 'directions', 'db', 'total'):
+                self.assertIn(f'{name};dur=', timing)
+
+            metrics = client.get('/metrics').get_data(as_text=True)
+        self.assertIn('# TYPE ride_finder_request_duration_seconds histogram', metrics)
+        self.assertIn('ride_finder_request_duration_seconds_count{endpoint="/search"}', metrics)
+        self.assertIn('ride_finder_upstream_duration_seconds_bucket{api="departures",le="+Inf"}', metrics)
+        self.assertIn('# TYPE ride_finder_geocode_cache_lookups_total counter', metrics)
+        self.assertIn('ride_finder_geocode_cache_lookups_total{tier="database",result="miss"}', metrics)
+
+        for model in (Search, RouteData, StationDirection, Station, OriginInfo, SearchSession):
+            model.query.delete()
+        db.session.commit()
+
+
+    def test_concurrent_renders_are_timed_apart(self):
+        """
+        Are two threads rendering the same template at once each timed from
+        their own start, and does a statement that fails leave nothing behind?
+        """
+        template = app.jinja_env.get_template('about.html')
+        durations = {}
+
+        def render(name, seconds):
+            metrics = instrumentation.RequestMetrics()
+            instrumentation._CURRENT.set(metrics)
+            instrumentation._before_render(app, template, {})
+            time.sleep(seconds)
+            instrumentation._rendered(app, template, {})
+            durations[name] = metrics.items()[0][2]
+
+        slow = threading.Thread(target=render, args=('slow', 0.3))
+        fast = threading.Thread(target=render, args=('fast', 0.05))
+        slow.start()
+        time.sleep(0.1)
+        fast.start()
+        for thread in (slow, fast):
+            thread.join()
+        self.assertGreaterEqual(durations['slow'], 0.3)
+        self.assertLess(durations['fast'], 0.3)
+
+        with db.engine.connect() as conn:
+            with self.assertRaises(Exception):
+                conn.exec_driver_sql('SELECT * FROM no_such_table')
+            self.assertNotIn('statement_started', conn.info)
+    
+
+    def test_init_db_command(self):
+        """Does 'flask init-db' create the tables, now that starting the app doesn't?"""
+        db.session.commit()
+        db.session.remove()
+        db.drop_all()
+        self.assertNotIn(User.__tablename__, inspect(db.engine).get_table_names())
+
+        result = app.test_cli_runner().invoke(args=['init-db'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('Created the database tables.', result.output)
+        self.assertLessEqual(set(db.metadata.tables), set(inspect(db.engine).get_table_names()))
@@ -1,16 +1,55 @@
+import asyncio
+import io
+import os
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import date, datetime
 from typing import Dict, List, Tuple
-from unittest import TestCase
+from contextvars import ContextVar
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
 
 from decouple import config
 import googlemaps
+from requests import Response
+from requests.adapters import BaseAdapter
 
+import async_transit as at
+from app import app
 import get_routes as gr
+import cassette
+from cache import TTLCache
+from gtfs import Feed
+from http_client import CLIENT, TransitClient
+from models import db
+from polyline import decode_flexible, encode_google, simplify
+from routing import find_terminal_stop
+from spatial import StationIndex
 
 
 KEY = config('HERE_API_KEY')
 STATIONS_URL = 'https://transit.hereapi.com/v8/departures'
 GEOCODE_URL = 'https://geocoder.ls.hereapi.com/6.2/geocode.json?apiKey={key}&searchtext={search}'
-GMAPS = googlemaps.Client(key=config('GOOGLE_API_KEY'))
+GMAPS = googlemaps.Client(key=config('GOOGLE_API_KEY'), requests_session=CLIENT.session('maps.googleapis.com'))
+
+
+def setUpModule():
+    # the geocode cache reads and writes its table, so the tests run in an app context
+    global CASSETTE, APP_CONTEXT
+    app.config['SQLALCHEMY_DATABASE_URI'] = config('TEST_DB')
+    APP_CONTEXT = app.app_context()
+    APP_CONTEXT.push()
+    db.create_all()
+    CASSETTE = cassette.install()
+
+
+def tearDownModule():
+    APP_CONTEXT.pop()
+    CLIENT.mount(None)
+    if CASSETTE and CASSETTE.mode == 'record':
+        CASSETTE.save()
 
 
 class GetRouteInfoTestCase(TestCase):
@@ -42,13 +81,60 @@ class GetRouteInfoTestCase(TestCase):
         ]
     
 
-    def mock_times(self) -> List[Tuple[str]]:
+    def mock_times(self) -> List[Tuple[str, str]]:
         return [
             ("2021-08-23T05:35:42", "2021-08-23 @05:35 AM"),
-            ("2021-06-07T11:09:34", "2021-06-07 @11:09 AM")
+            ("2021-06-07T11:09:34", "2021-06-07 @11:09 AM"),
+            ("2021-08-23T17:05:00-05:00", "2021-08-23 @17:05 PM"),
+            ("2021-12-01T23:59:00Z", "2021-12-01 @23:59 PM"),
+            ("Aug 23 2021 5:35am", "2021-08-23 @05:35 AM")
         ]
 
 
+    def mock_feed(self) -> io.BytesIO:
+        """
+        A small GTFS feed: a weekday bus that runs past midnight, a weekday
+        train and a weekend train, with Labor Day run on the weekend service.
+        """
+        files = {
+            'agency.txt': 'agency_id,agency_name,agency_url,agency_timezone\n'
+                          'CTA,Chicago Transit Authority,https://transitchicago.com,America/Chicago\n',
+            'stops.txt': 'stop_id,stop_name,stop_lat,stop_lon\n'
+                         'union,Union Station,41.8787,-87.6403\n'
+                         'clinton,Clinton,41.8756,-87.6412\n'
+                         'aurora,Aurora,41.7606,-88.3201\n',
+            'routes.txt': 'route_id,route_short_name,route_long_name,route_type,route_url\n'
+                          '151,151,Sheridan,3,\n'
+                          'bnsf,BNSF,BNSF Railway,2,https://metrarail.com\n',
+            'trips.txt': 'route_id,service_id,trip_id,trip_headsign\n'
+                         '151,weekday,late_bus,Devon/Clark\n'
+                         '151,weekday,early_bus,Devon/Clark\n'
+                         'bnsf,weekday,train_1,Aurora\n'
+                         'bnsf,weekend,train_w,Aurora\n',
+            'calendar.txt': 'service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n'
+                            'weekday,1,1,1,1,1,0,0,20210101,20211231\n'
+                            'weekend,0,0,0,0,0,1,1,20210101,20211231\n',
+            'calendar_dates.txt': 'service_id,date,exception_type\n'
+                                  'weekday,20210906,2\n'
+                                  'weekend,20210906,1\n',
+            'stop_times.txt': 'trip_id,arrival_time,departure_time,stop_id,stop_sequence\n'
+                              'late_bus,24:10:00,24:10:00,union,1\n'
+                              'late_bus,24:20:00,24:20:00,clinton,2\n'
+                              'early_bus,06:00:00,06:00:00,union,1\n'
+                              'early_bus,06:10:00,06:10:00,clinton,2\n'
+                              'train_1,07:30:00,07:32:00,union,1\n'
+                              'train_1,08:40:00,08:40:00,aurora,2\n'
+                              'train_w,09:00:00,09:00:00,union,1\n'
+                              'train_w,10:10:00,10:10:00,aurora,2\n'
+        }
+        feed = io.BytesIO()
+        with zipfile.ZipFile(feed, 'w') as archive:
+            for name, text in files.items():
+                archive.writestr(name, text)
+        feed.seek(0)
+        return feed
+
+
     def test_create_search_strings(self):
         """
         Does the function for making nicely formatted search strings
@@ -142,7 +228,8 @@ class GetRouteInfoTestCase(TestCase):
         data = ['Grant St', 'bus', 'S13', 'Grant St Pittsburgh']
         origin_coords = {'latitude': 40.441414, 'longitude': -79.994708}
         address = 'Pittsburgh, PA'
-        data2 = ['Boston', 'regionalTrain', 'Crescent', 'Boston South Station']
+        data2 = gr.Departure('2021-08-23 @05:35 AM', 'regionalTrain', 'Crescent', 'Boston South Station',
+                             'Boston', 'None Provided')
         address2 = 'Culpeper, VA'
         origin_coords2 = {'latitude': 38.156, 'longitude': -77.25}
         lat, lng = gr.get_destination_coordinates(address, origin_coords)
@@ -193,4 +280,404 @@ class GetRouteInfoTestCase(TestCase):
         direction = directions[0]['html_instructions']
         self.assertIn('<b>', direction)
         expected_directions = gr.get_directions_to_station(start_address, station_address)
-        self.assertNotIn('<b>', expected_directions)
\ No newline at end of file
+        self.assertNotIn('<b>', expected_directions)
+
+    def test_get_directions_to_stations_keeps_order(self):
+        """
+        Do the concurrent directions come back in the same order as the
+        stations, with a failed station degrading to an empty list, and
+        are they then served from the cache for a nearby origin?
+        """
+        calls = []
+
+        def fake_directions(start, station):
+            calls.append(station)
+            if station == (38.5, -78.0):
+                raise IndexError
+            return [f'Walk to {station[0]}']
+
+        stations = {0: ['first station', 38.47, -77.99], 1: ['bad station', 38.5, -78.0],
+                    2: ['third station', 38.48, -77.98], 3: ['first station', 38.47, -77.99]}
+        gr.DIRECTIONS_CACHE.clear()
+        with patch.object(gr, 'get_directions_to_station', fake_directions):
+            directions = gr.get_directions_to_stations((38.4733, -77.9961), stations)
+            again = gr.get_directions_to_stations((38.47331, -77.99611), stations)
+
+        self.assertEqual(directions, [['Walk to 38.47'], [], ['Walk to 38.48'], ['Walk to 38.47']])
+        self.assertEqual(again, directions)
+        # each station once, and only the failed one again
+        self.assertEqual(len(calls), 4)
+        gr.DIRECTIONS_CACHE.clear()
+
+
+    def test_run_concurrently_keeps_context(self):
+        """
+        Do the calls fanned out to the thread pool see the caller's context
+        variables, where Flask keeps the app context they need for the database?
+        """
+        user = ContextVar('user', default=None)
+        user.set('request')
+        self.assertEqual(gr._run_concurrently(lambda i: (i, user.get()), [(0,), (1,)], 5, None),
+                         [(0, 'request'), (1, 'request')])
+
+
+    def test_run_concurrently_shares_pool(self):
+        """
+        Do batches share one bounded thread pool, with the calls that
+        don't finish in time replaced by the default?
+        """
+        def call(seconds):
+            time.sleep(seconds)
+            return seconds
+
+        self.assertEqual(gr._run_concurrently(call, [(0,), (0.5,)], 0.1, None), [0, None])
+        for _ in range(3):
+            self.assertEqual(gr._run_concurrently(call, [(0,)] * 20, 5, None), [0] * 20)
+        self.assertLessEqual(len(gr.EXECUTOR._threads), gr.MAX_WORKERS)
+
+
+    def test_ttl_cache(self):
+        """
+        Does the cache evict the least recently used entry once full,
+        expire old entries, and count its hits and misses?
+        """
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        cache.set('d', 4, ttl=0)
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual(cache.stats, {"hits": 1, "misses": 2, "size": 1})
+
+
+    def test_ttl_cache_single_flight(self):
+        """
+        Do concurrent misses for the same key share a single call and its
+        result, while None results are not cached, so the next request retries?
+        """
+        cache = TTLCache()
+        calls = []
+
+        def slow_board():
+            calls.append(1)
+            time.sleep(0.05)
+            return ['board']
+
+        threads = [threading.Thread(target=cache.get_or_set, args=('cell', slow_board)) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.get('cell'), ['board'])
+        self.assertIsNone(cache.get_or_set('empty', lambda: None))
+        self.assertIsNone(cache.get('empty'))
+
+        # when the call fails, every waiter gets its None at once, and the next request tries again
+        retries = []
+        results = []
+
+        def failing_board():
+            retries.append(1)
+            time.sleep(0.2)
+            return None if len(retries) == 1 else ['board']
+
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_set('down', failing_board)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(retries), 1)
+        self.assertEqual(results, [None] * 5)
+        self.assertEqual(cache._flights, {})
+        self.assertEqual(cache.get_or_set('down', failing_board), ['board'])
+        self.assertEqual(len(retries), 2)
+    
+
+    def test_snap_coordinates(self):
+        """Do coordinates in the same grid cell share a key?"""
+        self.assertEqual(gr.snap_coordinates(41.87871, -87.64031, 0.001),
+                         gr.snap_coordinates(41.87869, -87.64029, 0.001))
+        self.assertNotEqual(gr.snap_coordinates(41.8787, -87.6403, 0.001),
+                            gr.snap_coordinates(41.8807, -87.6403, 0.001))
+
+
+    def test_transit_client_retries(self):
+        """
+        Does the HTTP client retry a 503 on the same pooled session,
+        and record the latency of every attempt for the endpoint?
+        """
+        statuses = [503, 200]
+
+        class FlakyAdapter(BaseAdapter):
+            def send(self, request, **kwargs):
+                response = Response()
+                response.status_code = statuses.pop(0)
+                response.url = request.url
+                response.request = request
+                return response
+
+            def close(self):
+                pass
+
+        client = TransitClient(backoff=0)
+        client.session('transit.example.com').mount('https://', FlakyAdapter())
+        response = client.get('https://transit.example.com/v8/departures', params={'in': '1,2'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(client.latency_stats()['transit.example.com/v8/departures']['count'], 2)
+
+
+    def test_station_index(self):
+        """
+        Does the station index find stations within a radius, closest first,
+        ignore duplicates, and find stations across cell borders?
+        """
+        index = StationIndex(cell_size=0.01)
+        index.add_all([
+            (1, 'Union Station', 41.8787, -87.6403),
+            (2, 'Clinton', 41.8756, -87.6412),
+            (3, 'Union Station', 41.8787, -87.6403),
+            (4, 'Midway', 41.7868, -87.7522),
+            (5, 'Across The Border', 41.8801, -87.6399)
+        ])
+
+        nearby = index.within(41.8789, -87.6400, 500)
+        self.assertEqual([s.name for s in nearby], ['Union Station', 'Across The Border', 'Clinton'])
+        self.assertEqual(index.nearest(41.8789, -87.6400, 1, 500)[0].name, 'Union Station')
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.last_id, 5)
+
+
+    def test_route_polylines(self):
+        """
+        Are HERE's flexible polylines decoded, simplified within the tolerance
+        and encoded as Google polylines, and is the shape to each destination
+        fetched once, and not at all for a destination at the origin?
+        """
+        here = [(50.10228, 8.69821), (50.10201, 8.69567), (50.10063, 8.6915), (50.09878, 8.68752)]
+        self.assertEqual(decode_flexible('BFoz5xJ67i1B1B7PzIhaxL7Y'), here)
+        # the same line with a third dimension, which is dropped
+        self.assertEqual(decode_flexible('BlBoz5xJ67i1BU1B7PUzIhaUxL7YU'), here)
+        self.assertEqual(encode_google([(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]),
+                         '_p~iF~ps|U_ulLnnqC_mqNvxq`@')
+
+        # a point 5 meters off a straight line goes, the corner stays
+        line = [(41.0, -87.0), (41.001, -87.00006), (41.002, -87.0), (41.002, -87.01)]
+        self.assertEqual(simplify(line, 15), [(41.0, -87.0), (41.002, -87.0), (41.002, -87.01)])
+        self.assertEqual(simplify(line, 1), line)
+
+        # the sections of a route share their end points, which are only kept once
+        response = {"routes": [{"sections": [{"polyline": 'BFoz5xJ67i1B1B7P'}, {"polyline": 'BFyx5xJ-ri1BzIhaxL7Y'}]}]}
+        self.assertEqual(gr.route_geometry(response), encode_google(here))
+        self.assertIsNone(gr.route_geometry({"routes": [{"sections": [{"type": "pedestrian"}]}]}))
+
+        calls = []
+        def fake_geometry(start, end):
+            calls.append(end)
+            return 'shape' if end != (41.9, -87.7) else None
+
+        origin = (41.8789, -87.64)
+        destinations = [(41.76, -88.32), origin, (41.9, -87.7), (41.76, -88.32)]
+        gr.ROUTE_GEOMETRY_CACHE.clear()
+        with patch.object(gr, 'get_route_geometry', fake_geometry):
+            shapes = gr.get_route_geometries(origin, destinations)
+            again = gr.get_route_geometries(origin, destinations)
+        self.assertEqual(shapes, ['shape', None, None, 'shape'])
+        self.assertEqual(again, shapes)
+        # each destination once, and only the one HERE couldn't route to again
+        self.assertEqual(calls, [(41.76, -88.32), (41.9, -87.7), (41.9, -87.7)])
+        gr.ROUTE_GEOMETRY_CACHE.clear()
+
+
+    def test_find_stations_near(self):
+        """
+        Is the departures board only fetched when the stations aren't known
+        locally, and handed back with the stations read from it?
+        """
+        local = {0: ['Union Station', 41.8787, -87.6403]}
+        boards = [{"place": {"name": "Clinton", "location": {"lat": 41.8756, "lng": -87.6412}}, "departures": []}]
+        with patch.object(gr, 'find_local_stations_near', lambda lat, lng: local), \
+             patch.object(gr, '_get_routes_and_stations', lambda lat, lng: self.fail('HERE was called')):
+            self.assertEqual(gr.find_stations_near(41.8789, -87.64), (local, None))
+        with patch.object(gr, 'find_local_stations_near', lambda lat, lng: {}), \
+             patch.object(gr, '_get_routes_and_stations', lambda lat, lng: boards):
+            self.assertEqual(gr.find_stations_near(41.8789, -87.64), ({0: ['Clinton', 41.8756, -87.6412]}, boards))
+
+
+    def test_iter_departures(self):
+        """
+        Does a station's board parse into Departures with named fields?
+        """
+        board = {
+            'place': {'name': 'Union Station', 'location': {'lat': 41.8787, 'lng': -87.6403}},
+            'departures': [
+                {
+                    'time': '2021-08-23T17:05:00-05:00',
+                    'transport': {'mode': 'bus', 'name': '151', 'headsign': 'To Devon/Clark'},
+                    'agency': {'name': 'CTA'}
+                }
+            ]
+        }
+
+        departures = gr.iter_departures(board)
+        self.assertEqual(next(departures), gr.Departure('2021-08-23 @17:05 PM', 'bus', '151', 'To Devon/Clark',
+                                                        ' Devon/Clark', 'None Provided'))
+        self.assertIsNone(next(departures, None))
+        self.assertEqual(gr.collect_route_information([board])[0][0][0].long_name, ' Devon/Clark')
+
+
+    def test_gtfs_feed(self):
+        """
+        Does a GTFS feed load offline and answer stops near a point and the
+        next departures, including trips left over from the day before,
+        but not departures from the last stop of a trip, and only from the
+        trips whose service runs that day?
+        """
+        feed = Feed.load(self.mock_feed())
+        self.assertEqual(feed.timezone, 'America/Chicago')
+        self.assertEqual([stop.stop_id for stop in feed.stops_near(41.8789, -87.6400, 500, 5)], ['union', 'clinton'])
+
+        # Monday 2021-08-23: the weekday trips, and Sunday's service had nothing running past midnight
+        monday = feed.next_departures('union', 0, 5, date(2021, 8, 23))
+        self.assertEqual([(d.time, d.trip.trip_id) for d in monday],
+                         [(21600, 'early_bus'), (27120, 'train_1'), (87000, 'late_bus')])
+        self.assertEqual([d.time for d in feed.next_departures('union', 27121, 5, date(2021, 8, 23))], [87000])
+        # Saturday: Friday's late bus, then only the weekend train
+        saturday = feed.next_departures('union', 0, 5, date(2021, 8, 28))
+        self.assertEqual([(d.time, d.trip.trip_id) for d in saturday], [(600, 'late_bus'), (32400, 'train_w')])
+        # Labor Day runs the weekend service instead of the weekday one
+        holiday = feed.next_departures('union', 0, 5, date(2021, 9, 6))
+        self.assertEqual([d.trip.trip_id for d in holiday], ['train_w'])
+        self.assertEqual(len(feed.next_departures('union', 0, 10)), 5)
+        self.assertEqual(feed.next_departures('aurora', 0, 5), [])
+        self.assertEqual(feed.trip_stop_ids('late_bus'), ['union', 'clinton'])
+        self.assertEqual(feed.trip_stop_ids('missing'), [])
+
+        scheduled = gr.get_scheduled_departures('Union Station', 41.8787, -87.6403,
+                                                now=datetime(2021, 8, 23, 7, 0), feed=feed)
+        self.assertEqual(scheduled[0], gr.Departure('2021-08-23 @07:32 AM', 'regionalTrain', 'BNSF', 'Aurora',
+                                                    'BNSF Railway', 'https://metrarail.com'))
+        self.assertEqual(scheduled[1].time, '2021-08-24 @00:10 AM')
+        self.assertIsNone(gr.get_scheduled_departures('Nowhere', 40.0, -80.0, feed=feed))
+        self.assertEqual(gr.find_scheduled_stops_near(41.7606, -88.3201, feed=feed), {0: ['Aurora', 41.7606, -88.3201]})
+
+
+    def test_find_terminal_stop(self):
+        """
+        Is a departure matched to its scheduled trip, so its destination
+        comes from the timetable without calling HERE?
+        """
+        feed = Feed.load(self.mock_feed())
+        self.assertEqual(find_terminal_stop(feed, 'union', 'BNSF', 'To Aurora', 7 * 3600 + 30 * 60).stop_id, 'aurora')
+        # no weekday train runs on a Saturday
+        self.assertIsNone(find_terminal_stop(feed, 'union', 'BNSF', 'Aurora', 7 * 3600 + 30 * 60, date(2021, 8, 28)))
+        self.assertEqual(find_terminal_stop(feed, 'union', '151', 'Devon/Clark', 10 * 60).stop_id, 'clinton')
+        self.assertIsNone(find_terminal_stop(feed, 'union', 'BNSF', 'Aurora', 12 * 3600))
+        self.assertIsNone(find_terminal_stop(feed, 'union', 'BNSF', 'Chicago', 7 * 3600 + 30 * 60))
+
+        departure = gr.Departure('2021-08-23 @07:32 AM', 'regionalTrain', 'BNSF', 'Aurora', 'BNSF Railway', '')
+        with patch.object(gr, 'get_feed', lambda: feed), \
+             patch.object(gr, 'get_destination_coordinates', lambda address, coords: self.fail('HERE was called')):
+            coords = gr.resolve_destination_coordinates(departure, 'Chicago, IL', {}, 'union')
+        self.assertEqual(coords, (41.7606, -88.3201))
+
+        # the late bus is found from a time past 24:00 on its service day, or the same time on the next day
+        late = gr.Departure('2021-08-23 @24:10 AM', 'bus', '151', 'Devon/Clark', 'Sheridan', '')
+        self.assertEqual(gr.get_scheduled_destination(late, 'union', feed), (41.8756, -87.6412))
+        self.assertEqual(gr.get_scheduled_destination(late._replace(time='2021-08-24 @00:10 AM'), 'union', feed),
+                         (41.8756, -87.6412))
+        self.assertIsNone(gr.get_scheduled_destination(late._replace(time='soon'), 'union', feed))
+
+
+    def test_cassette_replay(self):
+        """
+        Does a cassette record responses without their api keys, replay them
+        for the same request, or the same endpoint when allowed, and refuse
+        anything else?
+        """
+        class FakeTransport(BaseAdapter):
+            def send(self, request, **kwargs):
+                response = Response()
+                response.status_code = 200
+                response._content = b'{"boards": []}'
+                response.url = request.url
+                return response
+
+            def close(self):
+                pass
+
+        client = TransitClient(max_retries=0)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cassette.json')
+            recorder = cassette.Cassette(path, 'record', transport=FakeTransport())
+            client.mount(recorder)
+            client.get(gr.STATIONS_URL, params={"apikey": "secret", "in": "41.87,-87.64"})
+            recorder.save()
+            with open(path) as f:
+                self.assertNotIn('secret', f.read())
+
+            with cassette.use_cassette(path, client=client) as player:
+                self.assertEqual(client.get(gr.STATIONS_URL, params={"apikey": "other", "in": "41.87,-87.64"}).json(),
+                                 {"boards": []})
+                with self.assertRaises(cassette.CassetteMiss):
+                    client.get(gr.STATIONS_URL, params={"in": "1,2"})
+            self.assertEqual(player.calls['transit.hereapi.com/v8/departures'], 2)
+
+            # only a cassette that allows it answers for the endpoint
+            with cassette.use_cassette(path, client=client, match_endpoint=True):
+                self.assertEqual(client.get(gr.STATIONS_URL, params={"in": "1,2"}).json(), {"boards": []})
+                with self.assertRaises(cassette.CassetteMiss):
+                    client.get(gr.ROUTES_URL)
+
+
+    def test_shared_loop_keeps_context(self):
+        """
+        Do coroutines on the shared loop see the context variables of the
+        code that submitted them, from plain threads and from other loops?
+        """
+        user = ContextVar('user', default=None)
+
+        async def whose():
+            await asyncio.sleep(0)
+            return user.get()
+
+        async def from_another_loop():
+            user.set('async view')
+            return await at.LOOP.call(whose())
+
+        user.set('sync view')
+        self.assertEqual(at.LOOP.run(whose(), timeout=5), 'sync view')
+        self.assertEqual(asyncio.run(from_another_loop()), 'async view')
+
+
+    @skipUnless(at.httpx, 'needs httpx')
+    def test_async_directions(self):
+        """
+        Are the async directions stripped of tags, cached, and fetched
+        once per station over the shared async client?
+        """
+        calls = []
+
+        def handler(request):
+            calls.append(request.url.params['destination'])
+            body = {"routes": [{"legs": [{"steps": [{"html_instructions": "Head <b>north</b>"}]}]}]}
+            return at.httpx.Response(200, json=body)
+
+        client = at.AsyncTransitClient(transport=at.httpx.MockTransport(handler))
+        stations = {0: ['Union Station', 41.8787, -87.6403], 1: ['Union Station', 41.8787, -87.6403]}
+        gr.DIRECTIONS_CACHE.clear()
+        with patch.object(at, 'ASYNC_CLIENT', client):
+            directions = at.LOOP.run(at.get_directions_to_stations((41.8789, -87.64), stations), timeout=5)
+            again = at.LOOP.run(at.get_directions_to_stations((41.8789, -87.64), stations), timeout=5)
+            at.LOOP.run(client.aclose(), timeout=5)
+
+        self.assertEqual(directions, [['Head north'], ['Head north']])
+        self.assertEqual(again, directions)
+        self.assertEqual(calls, ['41.8787,-87.6403'])
+        gr.DIRECTIONS_CACHE.clear()